@@ -0,0 +1,241 @@
+"""Headless benchmarks of the plugin's hot paths.
+
+Loads run_ruby_test.py against the stand-in sublime module in this directory
+and a synthetic Rails-like project, times each benchmark a few times and
+prints (or saves) the median. Results saved with --output can be passed to
+--compare on a later run, which fails when a benchmark got slower than the
+threshold allows:
+
+  python bench/run.py --files 10000 --output before.json
+  python bench/run.py --files 10000 --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [BENCH_DIR, os.path.dirname(BENCH_DIR)]
+
+import sublime
+import tree
+import run_ruby_test as plugin
+
+clock = getattr(time, "perf_counter", time.time)
+BENCHMARKS = []
+
+def benchmark(function):
+  BENCHMARKS.append(function)
+  return function
+
+
+class Context(object):
+  def __init__(self, root, samples):
+    self.root = root
+    self.window = sublime.Window([root])
+    self.view = self.window.open_file(os.path.join(root, "app", "models", "ns0", "thing0.rb"))
+    self.task = plugin.RunSingleRubyTest(self.view)
+    self.task.load_settings()
+    self.ignored = sublime.load_settings("RubyTest.sublime-settings").get("ignored_directories")
+    self.paths = tree.sample(root, samples)
+    self.file_count = sum(len(names) for _, _, names in os.walk(root)) - 1
+
+  def ready_index(self):
+    index = plugin.ProjectFileIndex.for_folder(self.root, self.ignored)
+    index.wait()
+    while index.busy:
+      time.sleep(0.01)
+    return index
+
+
+@benchmark
+def file_type(context):
+  def run():
+    for path in context.paths:
+      context.task.detect_file_type(path)
+  return run, len(context.paths)
+
+@benchmark
+def find_partition_folder(context):
+  folders = ["/nonexistent/project%d" % n for n in range(50)] + [context.root]
+  task = plugin.RunSingleRubyTest(sublime.Window(folders).open_file(context.paths[0]))
+  def run():
+    for path in context.paths:
+      task.find_partition_folder(path, "spec")
+  return run, len(context.paths)
+
+@benchmark
+def project_files_scan(context):
+  def run():
+    plugin.ProjectFileIndex(context.root, context.ignored).build()
+  return run, context.file_count
+
+@benchmark
+def project_files_load(context):
+  context.ready_index().save()
+  def run():
+    plugin.ProjectFileIndex(context.root, context.ignored).load_from_disk()
+  return run, context.file_count
+
+@benchmark
+def project_files_alternates(context):
+  index = context.ready_index()
+  def run():
+    for path in context.paths:
+      index.alternates_of(path)
+  return run, len(context.paths)
+
+@benchmark
+def build_relative_paths(context):
+  context.ready_index()
+  command = plugin.GenerateTestFile(context.window, False)
+  return command.build_relative_paths, 1
+
+def locator_view(context):
+  view = context.window.new_file()
+  view.text = tree.test_file_source(50, 40)
+  return view
+
+@benchmark
+def test_locator_index(context):
+  view = locator_view(context)
+  def run():
+    plugin.TestLocator(view).refresh()
+  return run, view.text.count("\n")
+
+@benchmark
+def test_locator_reindex_after_edit(context):
+  view = locator_view(context)
+  locator = plugin.TestLocator(view)
+  locator.refresh()
+  edits = [0]
+  def run():
+    edits[0] += 1
+    view.text = view.text.replace("handles case 0.0", "handles case 0.0%d" % edits[0], 1)
+    locator.dirty = True
+    locator.refresh()
+  return run, view.text.count("\n")
+
+@benchmark
+def test_locator_lookup(context):
+  view = locator_view(context)
+  locator = plugin.TestLocator(view)
+  locator.refresh()
+  lines = range(1, view.text.count("\n") + 1)
+  def run():
+    for line in lines:
+      locator.test_at(line)
+  return run, len(lines)
+
+@benchmark
+def output_streaming(context):
+  lines = []
+  for n in range(50000):
+    if n % 5 == 0:
+      status = n % 100 == 0 and "failed" or "passed"
+      event = {"event": "example", "status": status, "file": "spec/models/thing_spec.rb", "line": n, "description": "example %d" % n, "message": "expected true"}
+      lines.append(plugin.RESULT_MARKER + json.dumps(event))
+    else:
+      lines.append("  log line %d: %s" % (n, "x" * 60))
+  output = "\n".join(lines) + "\n"
+  chunks = [output[i:i + 4096] for i in range(0, len(output), 4096)]
+  def run():
+    panel = plugin.OutputPanel(context.window.get_output_panel("bench.%d" % id(chunks)))
+    panel.view.text = ""
+    renderer = plugin.ResultRenderer(panel)
+    results = plugin.TestResults()
+    parser = plugin.ResultParser(results, renderer)
+    for number, chunk in enumerate(chunks):
+      parser.feed(chunk)
+      if number % 16 == 0:
+        sublime.run_timeouts()
+    parser.close()
+    renderer.finish(results, 1.0, 1)
+    sublime.run_timeouts()
+  return run, len(lines)
+
+
+def measure(run, repeat):
+  times = []
+  for _ in range(repeat):
+    started = clock()
+    run()
+    times.append(clock() - started)
+  times.sort()
+  return times
+
+def median(values):
+  middle = len(values) // 2
+  return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def compare(results, baseline, threshold):
+  regressions = []
+  print("")
+  print("%-34s %12s %12s %8s" % ("benchmark", "baseline", "current", "change"))
+  for name, result in sorted(results.items()):
+    before = baseline.get(name)
+    if not before:
+      print("%-34s %12s %12s %8s" % (name, "-", plugin.duration(result["median"]), "new"))
+      continue
+    # compare per-op times so runs over trees of different sizes stay comparable
+    change = result["per_op"] / before["per_op"] - 1
+    flag = change > threshold and "  REGRESSION" or ""
+    if flag:
+      regressions.append(name)
+    print("%-34s %12s %12s %+7.0f%%%s" % (name, plugin.duration(before["median"]), plugin.duration(result["median"]), change * 100, flag))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmarks run_ruby_test.py outside Sublime Text.")
+  parser.add_argument("--files", type=int, default=10000, help="files in the synthetic project (default 10000)")
+  parser.add_argument("--tree", help="where to generate the project (default: a directory under the temp dir, reused between runs)")
+  parser.add_argument("--samples", type=int, default=2000, help="paths used by the per-file benchmarks")
+  parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark; the median is reported")
+  parser.add_argument("--only", help="run only benchmarks whose name contains this")
+  parser.add_argument("--output", help="save the results as JSON")
+  parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+  parser.add_argument("--threshold", type=float, default=0.2, help="slowdown counted as a regression (default 0.2 = 20%%)")
+  args = parser.parse_args()
+
+  root = args.tree or os.path.join(tempfile.gettempdir(), "rubytest-bench-%d" % args.files)
+  started = clock()
+  tree.generate(os.path.abspath(root), args.files)
+  print("project: %s (%s to generate)" % (root, plugin.duration(clock() - started)))
+  context = Context(os.path.abspath(root), args.samples)
+
+  results = {}
+  print("%-34s %8s %12s %12s %12s" % ("benchmark", "ops", "median", "min", "per op"))
+  for function in BENCHMARKS:
+    if args.only and args.only not in function.__name__:
+      continue
+    run, ops = function(context)
+    times = measure(run, args.repeat)
+    result = {"ops": ops, "median": median(times), "min": times[0], "per_op": median(times) / max(ops, 1)}
+    results[function.__name__] = result
+    print("%-34s %8d %12s %12s %10.2fus" % (function.__name__, ops, plugin.duration(result["median"]), plugin.duration(result["min"]), result["per_op"] * 1e6))
+
+  report = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "files": context.file_count,
+    "repeat": args.repeat,
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "results": results,
+  }
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if baseline.get("files") != report["files"]:
+      print("\nnote: baseline used %s files, this run %s" % (baseline.get("files"), report["files"]))
+    if compare(results, baseline.get("results", {}), args.threshold):
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
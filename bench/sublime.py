@@ -0,0 +1,271 @@
+"""Stand-in for Sublime Text's sublime module, enough to drive run_ruby_test.py
+outside the editor.
+
+Callbacks passed to set_timeout are queued until run_timeouts() is called,
+which plays the part of the editor's main loop.
+"""
+import os
+import json
+import tempfile
+import threading
+import collections
+
+import sublime_plugin
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGES_PATH = tempfile.mkdtemp(prefix="rubytest-bench-packages-")
+
+_timeouts = collections.deque()
+_timeouts_lock = threading.Lock()
+_settings = {}
+_windows = []
+
+
+class Region(object):
+  def __init__(self, a, b=None):
+    self.a = a
+    self.b = a if b is None else b
+
+  def begin(self):
+    return min(self.a, self.b)
+
+  def end(self):
+    return max(self.a, self.b)
+
+  def empty(self):
+    return self.a == self.b
+
+
+class Settings(object):
+  def __init__(self, values=None):
+    self.values = dict(values or {})
+    self.callbacks = {}
+
+  def get(self, name, default=None):
+    return self.values.get(name, default)
+
+  def set(self, name, value):
+    self.values[name] = value
+
+  def has(self, name):
+    return name in self.values
+
+  def erase(self, name):
+    self.values.pop(name, None)
+
+  def add_on_change(self, key, callback):
+    self.callbacks[key] = callback
+
+  def clear_on_change(self, key):
+    self.callbacks.pop(key, None)
+
+
+class Edit(object):
+  pass
+
+
+class View(object):
+  _ids = [0]
+
+  def __init__(self, window, file_name=None, text=""):
+    View._ids[0] += 1
+    self._id = View._ids[0]
+    self._window = window
+    self._file_name = file_name
+    self._settings = Settings()
+    self._status = {}
+    self.text = text
+    self.selection = [Region(0)]
+    self.read_only = False
+    self.scratch = False
+
+  def id(self):
+    return self._id
+
+  def file_name(self):
+    return self._file_name
+
+  def window(self):
+    return self._window
+
+  def settings(self):
+    return self._settings
+
+  def size(self):
+    return len(self.text)
+
+  def substr(self, region):
+    if isinstance(region, Region):
+      return self.text[max(region.begin(), 0):region.end()]
+    return self.text[region]
+
+  def sel(self):
+    return self.selection
+
+  def line(self, region):
+    point = region.begin() if isinstance(region, Region) else region
+    start = self.text.rfind("\n", 0, point) + 1
+    end = self.text.find("\n", point)
+    return Region(start, len(self.text) if end == -1 else end)
+
+  def rowcol(self, point):
+    return self.text.count("\n", 0, point), point - self.text.rfind("\n", 0, point) - 1
+
+  def text_point(self, row, column):
+    point = 0
+    for _ in range(row):
+      point = self.text.index("\n", point) + 1
+    return point + column
+
+  def visible_region(self):
+    return Region(0, len(self.text))
+
+  def insert(self, edit, point, text):
+    self.text = self.text[:point] + text + self.text[point:]
+    return len(text)
+
+  def erase(self, edit, region):
+    self.text = self.text[:region.begin()] + self.text[region.end():]
+
+  def replace(self, edit, region, text):
+    self.text = self.text[:region.begin()] + text + self.text[region.end():]
+
+  def begin_edit(self, *args):
+    return Edit()
+
+  def end_edit(self, edit):
+    pass
+
+  def set_read_only(self, read_only):
+    self.read_only = read_only
+
+  def set_scratch(self, scratch):
+    self.scratch = scratch
+
+  def set_syntax_file(self, syntax):
+    pass
+
+  def set_status(self, key, value):
+    self._status[key] = value
+
+  def erase_status(self, key):
+    self._status.pop(key, None)
+
+  def set_viewport_position(self, position, animate=True):
+    pass
+
+  def show(self, point, show_surrounds=True):
+    pass
+
+  def is_loading(self):
+    return False
+
+  def run_command(self, name, args=None):
+    command = sublime_plugin.text_command(name)
+    if command:
+      command(self).run(Edit(), **(args or {}))
+
+
+class Window(object):
+  _ids = [0]
+
+  def __init__(self, folders=()):
+    Window._ids[0] += 1
+    self._id = Window._ids[0]
+    self._folders = list(folders)
+    self._views = []
+    self._active_view = None
+    self.panels = {}
+    self.commands = []
+    _windows.append(self)
+
+  def id(self):
+    return self._id
+
+  def folders(self):
+    return self._folders
+
+  def views(self):
+    return list(self._views)
+
+  def active_view(self):
+    return self._active_view
+
+  def new_file(self):
+    return self.open_file(None)
+
+  def open_file(self, file_name, flags=0):
+    for view in self._views:
+      if file_name and view.file_name() == file_name:
+        self._active_view = view
+        return view
+    text = ""
+    if file_name and os.path.isfile(file_name):
+      with open(file_name) as f:
+        text = f.read()
+    view = View(self, file_name, text)
+    self._views.append(view)
+    self._active_view = view
+    return view
+
+  def get_output_panel(self, name):
+    if name not in self.panels:
+      self.panels[name] = View(self)
+    return self.panels[name]
+
+  def run_command(self, name, args=None):
+    self.commands.append((name, args))
+
+  def show_quick_panel(self, items, on_done, *args):
+    self.commands.append(("show_quick_panel", items))
+
+  def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+    self.commands.append(("show_input_panel", initial_text))
+
+  def focus_view(self, view):
+    self._active_view = view
+
+
+def active_window():
+  return _windows and _windows[-1] or Window()
+
+def windows():
+  return list(_windows)
+
+def packages_path():
+  return PACKAGES_PATH
+
+def load_settings(name):
+  if name not in _settings:
+    values = {}
+    path = os.path.join(PACKAGE_DIR, name)
+    if os.path.isfile(path):
+      with open(path) as f:
+        values = json.load(f)
+    _settings[name] = Settings(values)
+  return _settings[name]
+
+def save_settings(name):
+  pass
+
+def set_timeout(callback, delay):
+  with _timeouts_lock:
+    _timeouts.append(callback)
+
+def run_timeouts():
+  """Runs queued set_timeout callbacks, including ones they queue, until none are left."""
+  while True:
+    with _timeouts_lock:
+      if not _timeouts:
+        return
+      callback = _timeouts.popleft()
+    callback()
+
+def status_message(message):
+  pass
+
+def error_message(message):
+  raise RuntimeError(message)
+
+def message_dialog(message):
+  pass
@@ -0,0 +1,34 @@
+"""Stand-in for Sublime Text's sublime_plugin module (see sublime.py)."""
+import re
+
+
+class TextCommand(object):
+  def __init__(self, view):
+    self.view = view
+
+
+class WindowCommand(object):
+  def __init__(self, window):
+    self.window = window
+
+
+class ApplicationCommand(object):
+  pass
+
+
+class EventListener(object):
+  pass
+
+
+def command_name(cls):
+  name = re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", cls.__name__).lower()
+  return name[:-len("_command")] if name.endswith("_command") else name
+
+def text_command(name):
+  pending = list(TextCommand.__subclasses__())
+  while pending:
+    cls = pending.pop()
+    if command_name(cls) == name:
+      return cls
+    pending.extend(cls.__subclasses__())
+  return None
@@ -0,0 +1,74 @@
+"""Synthetic Rails-like project trees for the benchmarks.
+
+Every "resource" adds a model, controller, view, lib file, spec, controller
+spec, unit test and feature, spread over namespaces of RESOURCES_PER_NAMESPACE
+resources, plus vendored gems that the plugin is expected to skip.
+"""
+import os
+import shutil
+
+RESOURCES_PER_NAMESPACE = 50
+MARKER = ".rubytest-bench"
+
+LAYOUT = [
+  ("app/models/{ns}", "{name}.rb", "class {Name} < ApplicationRecord\n  validates :title, presence: true\nend\n"),
+  ("app/controllers/{ns}", "{name}s_controller.rb", "class {Name}sController < ApplicationController\n  def show\n    @{name} = {Name}.find(params[:id])\n  end\nend\n"),
+  ("app/views/{ns}/{name}s", "show.html.erb", "<h1><%= @{name}.title %></h1>\n"),
+  ("lib/{ns}", "{name}_importer.rb", "require '{ns}/{name}'\n\nmodule {Name}Importer\nend\n"),
+  ("spec/models/{ns}", "{name}_spec.rb", "describe {Name} do\n  it \"is valid\" do\n    expect({Name}.new(title: 'x')).to be_valid\n  end\nend\n"),
+  ("spec/controllers/{ns}", "{name}s_controller_spec.rb", "describe {Name}sController do\n  it \"shows\" do\n  end\nend\n"),
+  ("test/models/{ns}", "{name}_test.rb", "class {Name}Test < Minitest::Test\n  def test_valid\n    assert {Name}.new.valid?\n  end\nend\n"),
+  ("features/{ns}", "{name}.feature", "Feature: {Name}\n  Scenario: show\n    Given a {name}\n"),
+  ("vendor/bundle/gems/{ns}/lib", "{name}.rb", "module {Name}\nend\n"),
+]
+
+def generate(root, files):
+  """Creates (or reuses) a tree of about `files` files under root."""
+  marker = os.path.join(root, MARKER)
+  if os.path.isfile(marker):
+    with open(marker) as f:
+      if f.read().strip() == str(files):
+        return root
+    shutil.rmtree(root)
+  resources = max(1, files // len(LAYOUT))
+  for resource in range(resources):
+    values = {"ns": "ns%d" % (resource // RESOURCES_PER_NAMESPACE), "name": "thing%d" % resource, "Name": "Thing%d" % resource}
+    for directory, name, content in LAYOUT:
+      directory = os.path.join(root, directory.format(**values))
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      with open(os.path.join(directory, name.format(**values)), "w") as f:
+        f.write(content.format(**values))
+  with open(marker, "w") as f:
+    f.write(str(files))
+  return root
+
+def sample(root, count):
+  """Up to count project files, spread evenly over the tree (vendor excluded)."""
+  paths = []
+  for directory, subdirs, names in os.walk(root):
+    subdirs[:] = sorted(d for d in subdirs if d != "vendor")
+    paths.extend(os.path.join(directory, name) for name in sorted(names) if name != MARKER)
+  step = max(1, len(paths) // count)
+  return paths[::step][:count]
+
+def test_file_source(groups, tests_per_group):
+  """An RSpec file with nested groups, blocks and heredocs."""
+  lines = ["require 'spec_helper'", "", "describe Widget do"]
+  for group in range(groups):
+    lines.append("  context \"group %d\" do" % group)
+    lines.append("    let(:widget) { Widget.new(id: %d) }" % group)
+    for test in range(tests_per_group):
+      lines.extend([
+        "    it \"handles case %d.%d\" do" % (group, test),
+        "      result = widget.call(%d) do |value|" % test,
+        "        value * 2 # doubled",
+        "      end",
+        "      if result > 10 then result -= 1 end",
+        "      expect(result).to eq(%d)" % (test * 2),
+        "    end",
+        "",
+      ])
+    lines.append("  end")
+  lines.append("end")
+  return "\n".join(lines) + "\n"
@@ -1,17 +1,49 @@
 import os
 import re
+import json
+import atexit
+import codecs
+import collections
+import contextlib
+import math
+import time
+import shlex
+import signal
+import hashlib
+import bisect
 import functools
+import threading
+import tempfile
+import subprocess
+import shutil
+import sys
 import sublime
 import string
 import sublime_plugin
 
+try:
+  import multiprocessing
+except ImportError:
+  pass
+
+try:
+  from shlex import quote as shell_quote
+except ImportError:
+  from pipes import quote as shell_quote
+
+def command_quote(argument):
+  """Quotes an argument of a command line for the platform's shell: test
+  commands run through cmd.exe on Windows, which takes double quotes only."""
+  return subprocess.list2cmdline([argument]) if os.name == "nt" else shell_quote(argument)
+
 class ShowInPanel:
-  def __init__(self, window):
+  def __init__(self, window, name="exec"):
     self.window = window
+    self.name = name
 
   def display_results(self):
-    self.panel = self.window.get_output_panel("exec")
-    self.window.run_command("show_panel", {"panel": "output.exec"})
+    self.panel = self.window.get_output_panel(self.name)
+    self.window.run_command("show_panel", {"panel": "output." + self.name})
     self.panel.settings().set("color_scheme", THEME)
     self.panel.set_syntax_file(SYNTAX)
     if HIDE_PANEL:
@@ -20,45 +52,18 @@ class ShowInPanel:
 
 
 class ShowInScratch:
-  def __init__(self, window):
+  def __init__(self, window, name="exec"):
     self.window = window
-    self.active_for = 0
-    self.copied_until = 0
+    self.title = "Test Results" + name[len("exec"):].replace(".", " - ", 1)
 
   def display_results(self):
-    self.panel = self.window.get_output_panel("exec")
     self.window.run_command("hide_panel")
-    self.view = self.window.open_file("Test Results")
+    self.view = self.window.open_file(self.title)
     self.view.set_scratch(True)
-    self.view.set_read_only(False)
-
     self.view.set_syntax_file(SYNTAX)
     self.view.settings().set("color_scheme", THEME)
     self.view.set_read_only(True)
-    self.poll_copy()
-    self.append('\n\n')
-
-  def poll_copy(self):
-    # FIXME HACK: Stop polling after one minute
-    if self.active_for < 60000:
-      self.active_for += 50
-      sublime.set_timeout(self.copy_stuff, 50)
-
-  def append(self, content):
-    self.view.set_read_only(False)
-    edit = self.view.begin_edit()
-    self.view.insert(edit, self.view.size(), content)
-    self.view.end_edit(edit)
-    self.view.set_read_only(True)
-    self.view.set_viewport_position((self.view.size(), self.view.size()), True)
-
-  def copy_stuff(self):
-    size = self.panel.size()
-    content = self.panel.substr(sublime.Region(self.copied_until, size))
-    if content:
-      self.copied_until = size
-      self.append(content)
-    self.poll_copy()
+    self.panel = self.view
 
 class ShowPanels:
   def __init__(self, window):
@@ -72,37 +77,802 @@ class ShowPanels:
                       })
     self.window.focus_group(1)
 
-class TestMethodMatcher(object):
+class AppendRubyTestOutput(sublime_plugin.TextCommand):
+  def run(self, edit, characters, erase=False):
+    self.view.set_read_only(False)
+    if erase:
+      self.view.erase(edit, sublime.Region(0, self.view.size()))
+    self.view.insert(edit, self.view.size(), characters)
+    self.view.set_read_only(True)
+
+class ReplaceRubyTestOutput(sublime_plugin.TextCommand):
+  def run(self, edit, begin, end, characters):
+    self.view.set_read_only(False)
+    self.view.replace(edit, sublime.Region(begin, end), characters)
+    self.view.set_read_only(True)
+
+
+class OutputPanel(object):
+  """Streams text into a results view from any thread.
+
+  Writes are coalesced into a single insert (and scroll) per frame of at most
+  MAX_INSERT characters. Once MAX_PENDING characters are waiting, writers on
+  other threads block until the view catches up, which stops the reader
+  thread from draining the child's pipe.
+
+  Everything written is also appended to a spill file, while the view keeps
+  only the last max_lines lines of output (plus the report written after
+  finish()): older lines are replaced by a single line pointing at
+  "RubyTest: Show Full Test Output".
+  """
+  MAX_INSERT = 65536
+  MAX_PENDING = 1048576
+  FRAME = 16
+
+  @staticmethod
+  def spill_path(view):
+    return storage_path("output-%d.log" % view.id())
+
+  def __init__(self, view, erase=True):
+    self.view = view
+    self.pending = []
+    self.pending_size = 0
+    self.scheduled = False
+    self.closed = False
+    self.finished = False
+    self.drained = threading.Condition()
+    self.start = view.size()
+    self.max_lines = MAX_OUTPUT_LINES
+    self.written_lines = 0
+    self.hidden = 0
+    self.spill = codecs.open(self.spill_path(view), erase and "w" or "a", "utf-8")
+
+  def close(self):
+    """Drops pending and later output, e.g. of a run replaced by a newer one."""
+    with self.drained:
+      self.closed = True
+      self.pending = []
+      self.pending_size = 0
+      self.close_spill()
+      self.drained.notify_all()
+
+  def finish(self, report):
+    """Writes the report ending the output, which unlike the output is never trimmed."""
+    with self.drained:
+      self.finished = True
+    self.write(report)
+    with self.drained:
+      self.close_spill()
+
+  def close_spill(self):
+    if self.spill:
+      self.spill.close()
+      self.spill = None
+
+  def write(self, text, log=None):
+    """Shows text in the view and appends log (text by default) to the spill file."""
+    with self.drained:
+      if self.closed:
+        return
+      if self.spill:
+        self.spill.write(text if log is None else log)
+      if not text:
+        return
+      while self.pending_size > self.MAX_PENDING and threading.current_thread() is not MAIN_THREAD:
+        self.drained.wait(1)
+      self.pending.append(text)
+      self.pending_size += len(text)
+      if not self.finished:
+        self.written_lines += text.count("\n")
+      if self.scheduled:
+        return
+      self.scheduled = True
+    sublime.set_timeout(self.flush, self.FRAME)
+
+  def flush(self):
+    with self.drained:
+      text = "".join(self.pending)
+      chunk, rest = text[:self.MAX_INSERT], text[self.MAX_INSERT:]
+      self.pending = rest and [rest] or []
+      self.pending_size = len(rest)
+      self.scheduled = bool(rest)
+      self.drained.notify_all()
+    if chunk:
+      self.view.run_command("append_ruby_test_output", {"characters": chunk})
+      self.trim()
+      self.view.show(self.view.size())
+    if rest:
+      sublime.set_timeout(self.flush, self.FRAME)
+
+  def trim(self):
+    """Replaces the oldest output lines with a note once there are a tenth more than max_lines."""
+    if not self.max_lines:
+      return
+    first_row = self.view.rowcol(self.start)[0] + (self.hidden and 1 or 0)
+    rows = min(self.view.rowcol(self.view.size())[0] - first_row, self.written_lines - self.hidden)
+    excess = rows - self.max_lines
+    if excess <= self.max_lines // 10:
+      return
+    self.hidden += excess
+    note = "[%d earlier lines not shown, see RubyTest: Show Full Test Output]\n" % self.hidden
+    end = self.view.text_point(first_row + excess, 0)
+    self.view.run_command("replace_ruby_test_output", {"begin": self.start, "end": end, "characters": note})
+
+class TestProcess(object):
+  """Runs a command in the background, handing decoded output to on_output.
+
+  Both callbacks are invoked from the reader thread. The command gets a
+  process group of its own so kill() also stops whatever it spawned.
+  """
+  KILL_AFTER = 3
+
+  def __init__(self, cmd, shell, env, working_dir, on_output, on_finished):
+    self.on_output = on_output
+    self.on_finished = on_finished
+    self.started_at = time.time()
+    self.first_output_at = None
+    self.killed = False
+    process_env = os.environ.copy()
+    process_env.update(env or {})
+    self.process = subprocess.Popen(cmd, shell=shell, env=process_env, cwd=working_dir or None, startupinfo=hidden_window(),
+      preexec_fn=os.name != "nt" and os.setsid or None,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=os.name != "nt")
+    self.process.stdin.close()
+    threading.Thread(target=self.read_output).start()
+
+  def read_output(self):
+    decoder = codecs.getincrementaldecoder(TERMINAL_ENCODING or "utf-8")("replace")
+    while True:
+      data = os.read(self.process.stdout.fileno(), 65536)
+      if not data:
+        break
+      self.first_output_at = self.first_output_at or time.time()
+      self.on_output(decoder.decode(data).replace("\r\n", "\n"))
+    self.process.stdout.close()
+    self.on_finished(self.process.wait())
+
+  def elapsed(self):
+    return time.time() - self.started_at
+
+  def kill(self):
+    """Terminates the process group, killing it if it is still around KILL_AFTER seconds later."""
+    self.killed = True
+    if self.process.poll() is not None:
+      return
+    if os.name == "nt":
+      subprocess.call(["taskkill", "/F", "/T", "/PID", str(self.process.pid)], startupinfo=hidden_window())
+      return
+    self.signal_group(signal.SIGTERM)
+    timer = threading.Timer(self.KILL_AFTER, self.signal_group, [signal.SIGKILL])
+    timer.daemon = True
+    timer.start()
+
+  def signal_group(self, signum):
+    try:
+      os.killpg(self.process.pid, signum)
+    except OSError:
+      pass
+
+
+RESULT_MARKER = "\x1eRUBYTEST "
+RUBY_FILE_COMMAND = re.compile(r'(?:^|(?<=[\s/]))ruby(?:\s+-I\s*\S+)*\s+\{relative_path\}')
+RSPEC_COMMAND = re.compile(r'(?:^|(?<=[\s/]))rspec(?=\s|$)')
+RESULT_FILE_REGEX = r'^\s*(?:# |rspec |cucumber )?\.?/?([^\s:#\[\]]+\.(?:rb|feature|erb|haml)):(\d+)'
+
+def structured_command(command, env):
+  """Asks rspec (support/rspec_formatter.rb) and minitest
+  (support/minitest/rubytest_plugin.rb) to stream JSON results."""
+  support = os.path.join(PACKAGE_DIR, "support")
+  formatter = " --require %s --format RubyTestFormatter" % command_quote(os.path.join(support, "rspec_formatter.rb"))
+  command = RSPEC_COMMAND.sub(lambda match: match.group(0) + formatter, command, 1)
+  rubylib = [support] + [path for path in [env.get("RUBYLIB", os.environ.get("RUBYLIB"))] if path]
+  return command, dict(env, RUBYTEST_FORMAT="json", RUBYLIB=os.pathsep.join(rubylib))
+
+
+class TestResults(object):
+  """Examples reported by a run, as streamed by the RubyTest formatters."""
   def __init__(self):
-    self.matchers = [TestMethodMatcher.UnitTest, TestMethodMatcher.ShouldaTest]
-  def find_first_match_in(self, test_file_content):
-    for matcher in self.matchers:
-      test_name = matcher.find_first_match(test_file_content)
-      if test_name:
-        return test_name
-
-  class UnitTest(object):
-    @staticmethod
-    def find_first_match(test_file_content):
-      match_obj = re.search('\s?([a-zA-Z_\d]+tset)\s+fed', test_file_content) # 1st search for 'def test_name'
-      if match_obj:
-        return match_obj.group(1)[::-1]
-
-      match_obj = re.search('\s?[\"\']([a-zA-Z_\"\'\s\d\-\.#=?!:\/]+)[\"\']\s+tset', test_file_content) # 2nd search for 'test "name"'
-      if match_obj:
-        test_name = match_obj.group(1)[::-1]
-        return "test_%s" % test_name.replace("\"", "\\\"").replace(" ", "_").replace("'", "\\'")
+    self.examples = []
+    self.durations = {}
+    self.structured = False
+    self.lock = threading.Lock()
+
+  def add(self, example):
+    with self.lock:
+      self.examples.append(example)
+      if example.get("file") and example.get("duration") is not None:
+        path = os.path.normpath(example["file"])
+        self.durations[path] = self.durations.get(path, 0.0) + example["duration"]
+
+  def file_durations(self, files):
+    """Summed example durations of those of files that reported any."""
+    with self.lock:
+      return dict((f, self.durations[os.path.normpath(f)]) for f in files if os.path.normpath(f) in self.durations)
+
+  def with_status(self, status):
+    with self.lock:
+      return [example for example in self.examples if example.get("status") == status]
+
+  def failures(self):
+    return self.with_status("failed")
+
+  def summary(self):
+    counts = [(len(self.examples), "example"), (len(self.failures()), "failure"), (len(self.with_status("pending")), "pending")]
+    return ", ".join("%d %s%s" % (count, name, count != 1 and name != "pending" and "s" or "") for count, name in counts)
+
+
+class ResultParser(object):
+  """Splits a process' output into formatter events and plain output lines.
+
+  Without a formatter (cucumber, custom commands) the failing examples are
+  picked from the "rspec path:line" / "cucumber path:line" rerun lines.
+  """
+  FAILED_EXAMPLE = re.compile(r'^(rspec|cucumber) \.?/?(\S+?):(\d+)(?: # (.*))?$')
+
+  def __init__(self, results, renderer, prefix="", partial_lines=True):
+    self.results = results
+    self.renderer = renderer
+    self.prefix = prefix
+    self.partial_lines = partial_lines
+    self.buffer = ""
+    self.shown = 0
+
+  def feed(self, text):
+    """Parses the complete lines of text; with partial_lines the start of an
+    unfinished line is shown at once but kept for parsing until it ends."""
+    lines = (self.buffer + text).split("\n")
+    self.buffer = lines.pop()
+    for line in lines:
+      self.parse_line(line)
+    if self.partial_lines and len(self.buffer) > self.shown and "\x1e" not in self.buffer:
+      self.renderer.raw(("" if self.shown else self.prefix) + self.buffer[self.shown:], end="")
+      self.shown = len(self.buffer)
+
+  def close(self):
+    if self.buffer:
+      self.parse_line(self.buffer)
+      self.buffer = ""
+
+  def show(self, text):
+    """Shows a plain line, or what is left of it when its start was shown already."""
+    if self.shown:
+      text, self.shown = text[self.shown:], 0
+      self.renderer.raw(text, continued=True)
+    else:
+      self.renderer.raw(self.prefix + text)
+
+  def parse_line(self, line):
+    index = line.find(RESULT_MARKER)
+    event = None
+    if index >= 0:
+      try:
+        event = json.loads(line[index + len(RESULT_MARKER):])
+      except ValueError:
+        pass
+    if event is None:
+      self.show(line)
+      match = self.FAILED_EXAMPLE.match(line)
+      if match and not self.results.structured:
+        self.results.add({"status": "failed", "file": match.group(2), "line": int(match.group(3)), "description": match.group(4) or ""})
+      return
+    self.results.structured = True
+    if line[:index].strip() or self.shown:
+      self.show(line[:index])
+    if event.get("event") == "example":
+      self.results.add(event)
+      self.renderer.example(event)
+
+
+class ResultRenderer(object):
+  """Shows plain output as it comes, one progress character per example and
+  a failure list with locations once the run is over."""
+  PROGRESS = {"passed": ".", "failed": "F", "pending": "*"}
+  WIDTH = 80
+  BACKTRACE_LINES = 5
+
+  def __init__(self, panel):
+    self.panel = panel
+    self.column = 0
+    self.last_line = None
+    self.repeats = 0
+    self.lock = threading.Lock()
+
+  def raw(self, text, end="\n", continued=False):
+    """Shows a line of plain output; continued finishes the partial line shown last."""
+    with self.lock:
+      if end and not self.column and text.strip() and text == self.last_line:
+        self.repeats += 1
+        self.panel.write("", log=text + end)
+        return
+      repeated = self.repeated()
+      separator = self.column and end and not continued and "\n" or ""
+      self.last_line = end and not self.column and text or None
+      self.column = 0 if end else self.column + len(text)
+      self.panel.write(repeated + separator + text + end, log=separator + text + end)
+
+  def repeated(self):
+    """Note standing in for the repeats of the last line, which only the spill file gets."""
+    repeats, self.repeats = self.repeats, 0
+    if repeats == 1:
+      return self.last_line + "\n"
+    return repeats and "  [previous line repeated %d more times]\n" % repeats or ""
+
+  def example(self, example):
+    with self.lock:
+      repeated = self.repeated()
+      self.last_line = None
+      self.column += 1
+      newline = self.column % self.WIDTH == 0 and "\n" or ""
+      progress = self.PROGRESS.get(example.get("status"), "?") + newline
+      self.panel.write(repeated + progress, log=progress)
+
+  def finish(self, results, elapsed, returncode, killed=False, stages=()):
+    report = self.column and ["\n"] or []
+    failures = results.failures()
+    if failures:
+      report.append("\nFailures:\n")
+    for number, failure in enumerate(failures):
+      report.append("\n  %d) %s\n" % (number + 1, failure.get("description", "")))
+      report.append("     %s:%s\n" % (failure.get("file"), failure.get("line")))
+      if failure.get("location") and failure["location"] != "%s:%s" % (failure.get("file"), failure.get("line")):
+        report.append("     # %s (failed here)\n" % failure["location"])
+      for line in (failure.get("message") or "").splitlines():
+        report.append(("     %s" % line).rstrip() + "\n")
+      for line in (failure.get("backtrace") or [])[:self.BACKTRACE_LINES]:
+        report.append("     # %s\n" % line)
+    if results.examples:
+      report.append("\n%s\n" % results.summary())
+    timings = "".join("; %s %.1fs" % stage for stage in stages)
+    if killed:
+      report.append("[Cancelled]\n")
+    elif returncode:
+      report.append("[Finished in %.1fs with exit code %d%s]\n" % (elapsed, returncode, timings))
+    else:
+      report.append("[Finished in %.1fs%s]\n" % (elapsed, timings))
+    with self.lock:
+      repeated = self.repeated()
+      self.column = 0
+      self.last_line = None
+      self.panel.finish(repeated + "".join(report))
+
+
+class RunRegistry(object):
+  """The test run in progress for each project root.
+
+  Starting a run stops the one still running for the same project, and any
+  run writing to the same results view (project roots nested in one window
+  folder share it); other runs carry on. While anything runs, the status bar
+  of each window shows how long its runs have been going.
+  """
+  runs = {}
+  ticking = False
+
+  @classmethod
+  def register(cls, project_root, run):
+    view_id = run.results_view.id()
+    for root, previous in list(cls.runs.items()):
+      if previous is not run and (root == project_root or previous.results_view.id() == view_id):
+        previous.kill()
+        previous.panel.close()
+    cls.runs[project_root] = run
+    if not cls.ticking:
+      cls.ticking = True
+      cls.tick()
+
+  @classmethod
+  def finished(cls, project_root, run):
+    if cls.runs.get(project_root) is run:
+      del cls.runs[project_root]
+    sublime.set_timeout(lambda: cls.clear_status(run.window, project_root), 0)
+
+  @classmethod
+  def cancel(cls, project_root):
+    run = cls.runs.get(project_root)
+    if run:
+      run.kill()
+    return bool(run)
+
+  @classmethod
+  def tick(cls):
+    if not cls.runs:
+      cls.ticking = False
+      return
+    for project_root, run in list(cls.runs.items()):
+      view = run.window.active_view()
+      if view:
+        elapsed = int(time.time() - run.started_at)
+        view.set_status(cls.status_key(project_root), "RubyTest: %s running %d:%02d" % (os.path.basename(project_root), elapsed // 60, elapsed % 60))
+    sublime.set_timeout(cls.tick, 1000)
+
+  @classmethod
+  def clear_status(cls, window, project_root):
+    for view in window.views():
+      view.erase_status(cls.status_key(project_root))
+
+  @staticmethod
+  def status_key(project_root):
+    return "ruby_test_" + project_key(project_root)[:8]
+
+
+class Hook(object):
+  """A before_callback / after_callback command, run as a stage of a TestRun.
+
+  With watched files (before_callback_watch) the hook is skipped when it
+  already succeeded for the same command and modification times of those
+  files, e.g. a database reset keyed on db/schema.rb.
+  """
+  def __init__(self, name, command, project_root, timeout=0, watch=()):
+    self.name = name
+    self.command = command
+    self.project_root = project_root
+    self.timeout = timeout
+    self.watch = list(watch or ())
+    self.cache_file = storage_path("hooks-%s.json" % project_key(project_root))
+
+  def signature(self):
+    mtimes = [mtime(os.path.join(self.project_root, path)) for path in self.watch]
+    return hashlib.md5(json.dumps([self.command, self.watch, mtimes]).encode("utf-8")).hexdigest()
+
+  def is_fresh(self):
+    return bool(self.watch) and read_json(self.cache_file, {}).get(self.name) == self.signature()
+
+  def succeeded(self):
+    if self.watch:
+      signatures = read_json(self.cache_file, {})
+      signatures[self.name] = self.signature()
+      write_json(self.cache_file, signatures)
+
+
+class TestRun(object):
+  """A test command run by the plugin, reported through the result pipeline.
+
+  The before / after hooks run as stages in the background, one process
+  after the other: a failing before hook stops the run, the after hook runs
+  whatever the tests' outcome.
+  """
+  def __init__(self, window, cmd, shell, env, working_dir, results_view, on_success=None, erase=True, before=None, after=None, command=None, files=()):
+    self.window = window
+    self.files = list(files)
+    self.command = command or (isinstance(cmd, list) and " ".join(cmd) or cmd)
+    self.on_success = on_success
+    self.erase = erase
+    self.cmd = cmd
+    self.shell = shell
+    self.env = env
+    self.working_dir = working_dir
+    self.results_view = results_view
+    self.before = before
+    self.after = after
+    self.results = TestResults()
+    self.process = None
+    self.test_process = None
+    self.test_elapsed = 0
+    self.stages = []
+    self.killed = False
+    self.lock = threading.Lock()
+    self.profile = Profiler.current
+
+  def start(self):
+    self.started_at = time.time()
+    settings = self.results_view.settings()
+    settings.set("result_file_regex", RESULT_FILE_REGEX)
+    settings.set("result_base_dir", self.working_dir)
+    RunRegistry.register(self.working_dir, self)
+    self.results_view.run_command("append_ruby_test_output", {"characters": "", "erase": self.erase})
+    self.panel = OutputPanel(self.results_view, self.erase)
+    self.renderer = ResultRenderer(self.panel)
+    self.parser = ResultParser(self.results, self.renderer)
+    if self.before:
+      self.run_hook(self.before, lambda returncode: self.finished(returncode) if returncode else self.spawn())
+    else:
+      self.spawn()
 
-      return None
+  def spawn(self):
+    started = time.time()
+    try:
+      if not self.start_process(self.cmd, self.shell, self.env, self.parser.feed, self.tests_finished, test=True):
+        return self.finished(1)
+    except OSError as e:
+      self.panel.write("%s\n" % e)
+      return self.finished(127)
+    if self.profile is not None:
+      Profiler.add(self.profile, "spawn", time.time() - started)
+
+  def tests_finished(self, returncode):
+    with self.lock:
+      self.test_elapsed = self.test_process.elapsed()
+    self.parser.close()
+    if self.after and not self.killed:
+      self.run_hook(self.after, lambda _: self.finished(returncode))
+    else:
+      self.finished(returncode)
+
+  def run_hook(self, hook, then):
+    """Runs hook, then calls then with its exit code."""
+    if hook.is_fresh():
+      self.renderer.raw("[%s skipped, %s unchanged]" % (hook.name, ", ".join(hook.watch)))
+      return then(0)
+    self.renderer.raw("[%s] %s" % (hook.name, hook.command))
+    parser = ResultParser(TestResults(), self.renderer)
+    started = time.time()
+    timeout = []
+    def finished(returncode):
+      parser.close()
+      elapsed = time.time() - started
+      self.stages.append((hook.name, elapsed))
+      if self.profile is not None:
+        Profiler.add(self.profile, hook.name, elapsed)
+      if timeout:
+        timeout[0].cancel()
+      if returncode == 0:
+        hook.succeeded()
+        self.renderer.raw("[%s finished in %.1fs]" % (hook.name, elapsed))
+      elif not self.killed:
+        reason = timeout and timeout[0].expired and "timed out after %ds" % hook.timeout or "failed with exit code %d" % returncode
+        self.renderer.raw("[%s %s]" % (hook.name, reason))
+      then(returncode)
+    if hook.timeout:
+      timeout.append(HookTimeout(hook.timeout))
+    try:
+      process, returncode = self.start_process(hook.command, True, None, parser.feed, finished), 1
+    except OSError as e:
+      process, returncode = None, 127
+      self.panel.write("%s\n" % e)
+    if not process:
+      if timeout:
+        timeout[0].cancel()
+      return then(returncode)
+    if timeout:
+      timeout[0].watch(process)
+
+  def start_process(self, cmd, shell, env, on_output, on_finished, test=False):
+    """Starts the next process of the run, unless it was cancelled."""
+    with self.lock:
+      if not self.killed:
+        self.process = TestProcess(cmd, shell, env, self.working_dir, on_output, on_finished)
+        if test:
+          self.test_process = self.process
+        return self.process
+
+  def finished(self, returncode):
+    with self.lock:
+      killed = self.killed
+    elapsed = self.test_elapsed
+    self.renderer.finish(self.results, elapsed, returncode, killed, self.stages)
+    if not killed and self.test_process:
+      FailedExamples.for_project(self.working_dir).update(self.results)
+      if RECORD_HISTORY:
+        RunHistory.for_project(self.working_dir).record(self.command, elapsed, returncode, self.results)
+      if self.files:
+        timings = TestTimings.for_project(self.working_dir)
+        timings.record(self.files, elapsed, self.results)
+        timings.save()
+    RunRegistry.finished(self.working_dir, self)
+    if self.profile is not None and self.test_process:
+      if self.test_process.first_output_at:
+        Profiler.add(self.profile, "first_output", self.test_process.first_output_at - self.test_process.started_at)
+      Profiler.add(self.profile, "test_run", elapsed)
+    if returncode == 0 and not killed and self.on_success:
+      sublime.set_timeout(self.on_success, 0)
+
+  def kill(self):
+    with self.lock:
+      self.killed = True
+      if self.process:
+        self.process.kill()
+
+
+class HookTimeout(object):
+  """Kills a hook's process once it has run for longer than its timeout.
+
+  Armed before the process starts, so a hook finishing right away cancels it
+  before the run moves on; watch() hands it the process to kill."""
+  def __init__(self, timeout):
+    self.lock = threading.Lock()
+    self.process = None
+    self.expired = False
+    self.cancelled = False
+    self.timer = threading.Timer(timeout, self.expire)
+    self.timer.daemon = True
+    self.timer.start()
+
+  def watch(self, process):
+    with self.lock:
+      self.process = not self.cancelled and process or None
+      kill = self.expired and self.process
+    if kill:
+      kill.kill()
+
+  def expire(self):
+    with self.lock:
+      if self.cancelled:
+        return
+      self.expired = True
+      process = self.process
+    if process:
+      process.kill()
+
+  def cancel(self):
+    with self.lock:
+      self.cancelled = True
+      self.process = None
+    self.timer.cancel()
+
+
+class TestDefinition(object):
+  """A test or example group found by TestLocator, spanning lines start..end (1-based)."""
+  def __init__(self, start, kind, keyword, name):
+    self.start = self.end = start
+    self.kind = kind
+    self.keyword = keyword
+    self.name = name
+
+  def method_name(self):
+    """The test method minitest / test-unit defines for this test, if it is known."""
+    if self.keyword == "def":
+      return self.name
+    if self.keyword == "test":
+      return "test_%s" % self.name.replace(" ", "_")
+
+  def unit_test_name(self):
+    """The -n filter that selects this test in a minitest / test-unit run."""
+    if self.keyword == "def":
+      return self.name
+    if self.keyword == "test":
+      return "test_%s" % self.name.replace("\"", "\\\"").replace(" ", "_").replace("'", "\\'")
+    return "/%s/" % self.name
+
+
+def unit_test_pattern(tests):
+  """One -n filter selecting all of tests."""
+  if len(tests) == 1:
+    return tests[0].unit_test_name()
+  return "/%s/" % "|".join(test.method_name() and "^%s$" % re.escape(test.method_name()) or re.escape(test.name) for test in tests)
+
+
+class TestLocator(object):
+  """Index of the tests in a view: def test_*, test/should "...", it/describe/
+  context blocks and Cucumber scenarios, with the line ranges they cover.
+
+  Lines are tokenized once and memoized by their text, so re-indexing after an
+  edit only tokenizes the lines that changed. Block extents come from
+  balancing openers (do, {, def, class, if, ...) against end / } with strings
+  and comments stripped.
+  """
+  DEFINITION = re.compile(r"""^\s*(?:
+      def\s+(?P<method>test_\w+[?!]?)
+    | (?P<keyword>test|should|it|specify|example|scenario|describe|context|feature|shared_examples(?:_for)?|shared_context)
+      \s*\(?\s*(?:(?P<quote>["'])(?P<name>(?:\\.|(?!(?P=quote)).)*)(?P=quote)|(?=do\b|\{|[A-Z]))
+    | (?P<scenario>Scenario(?:\ Outline|\ Template)?|Example):\s*(?P<title>.*?)\s*$
+    )""", re.X)
+  FEATURE_BOUNDARY = re.compile(r"^\s*(?:Feature|Rule|Background|Scenario(?: Outline| Template)?|Example):")
+  STRING = re.compile(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'")
+  COMMENT = re.compile(r"#.*")
+  ESCAPE = re.compile(r"\\(.)")
+  OPENER = re.compile(r"^\s*(def|class|module|if|unless|while|until|case|begin|for)\b|=\s*(?:if|unless|case|begin)\b")
+  ENDLESS_DEF = re.compile(r"^\s*def\s+[\w.?!]+(?:\([^)]*\))?\s*=[^=~>]")
+  DO = re.compile(r"\bdo\b")
+  END = re.compile(r"(?<![.:])\bend\b")
+  GROUPS = ("describe", "context", "feature", "shared_examples", "shared_examples_for", "shared_context")
+
+  instances = {}
+
+  @classmethod
+  def for_view(cls, view):
+    locator = cls.instances.get(view.id())
+    if locator is None:
+      locator = cls.instances[view.id()] = cls(view)
+    return locator
+
+  @classmethod
+  def invalidate(cls, view):
+    locator = cls.instances.get(view.id())
+    if locator:
+      locator.dirty = True
+
+  def __init__(self, view):
+    self.view = view
+    self.memo = {}
+    self.definitions = []
+    self.tests = []
+    self.starts = []
+    self.dirty = True
+
+  def refresh(self):
+    if not self.dirty:
+      return self.definitions
+    with Profiler.phase("test_locator"):
+      return self.reindex()
+
+  def reindex(self):
+    self.dirty = False
+    lines = self.view.substr(sublime.Region(0, self.view.size())).split("\n")
+    memo = {}
+    tokens = []
+    for line in lines:
+      token = memo.get(line) or self.memo.get(line) or self.tokenize(line)
+      memo[line] = token
+      tokens.append(token)
+    self.memo = memo
+    self.definitions = self.index(tokens)
+    self.tests = [d for d in self.definitions if d.kind == "test"]
+    self.starts = [d.start for d in self.tests]
+    return self.definitions
+
+  def tokenize(self, line):
+    match = self.DEFINITION.match(line)
+    definition = None
+    if match and match.group("method"):
+      definition = ("test", "def", match.group("method"))
+    elif match and match.group("keyword"):
+      keyword = match.group("keyword")
+      name = match.group("name") and self.ESCAPE.sub(r"\1", match.group("name"))
+      definition = (keyword in self.GROUPS and "group" or "test", keyword, name)
+    elif match:
+      definition = ("test", match.group("scenario"), match.group("title"))
+    elif self.FEATURE_BOUNDARY.match(line):
+      definition = ("boundary", None, None)
+    code = self.COMMENT.sub("", self.STRING.sub('""', line))
+    opener = self.OPENER.search(code)
+    opens = code.count("{")
+    if opener and not (opener.group(1) == "def" and self.ENDLESS_DEF.match(code)):
+      opens += 1
+    if not (opener and opener.group(1) in ("while", "until", "for")):
+      opens += len(self.DO.findall(code))
+    closes = code.count("}") + len(self.END.findall(code))
+    return (definition, opens, closes)
+
+  def index(self, tokens):
+    definitions = []
+    open_blocks = []
+    scenarios = []
+    depth = 0
+    for number, (definition, opens, closes) in enumerate(tokens, 1):
+      depth_before = depth
+      depth = max(0, depth + opens - closes)
+      while open_blocks and depth <= open_blocks[-1][0]:
+        open_blocks.pop()[1].end = number
+      if definition is None:
+        continue
+      kind, keyword, name = definition
+      if kind == "boundary" or keyword[0].isupper():
+        scenarios.append(number)
+        if kind == "boundary":
+          continue
+      entry = TestDefinition(number, kind, keyword, name)
+      definitions.append(entry)
+      if depth > depth_before:
+        open_blocks.append((depth_before, entry))
+    for _, entry in open_blocks:
+      entry.end = len(tokens)
+    for entry in definitions:
+      if entry.keyword[0].isupper():
+        later = [line for line in scenarios if line > entry.start]
+        entry.end = later and later[0] - 1 or len(tokens)
+    return definitions
+
+  def test_at(self, line):
+    """The innermost test enclosing line, or else the last test above it."""
+    self.refresh()
+    index = bisect.bisect_right(self.starts, line)
+    return index and self.tests[index - 1] or None
+
+  def tests_between(self, first, last):
+    """The tests overlapping lines first..last, in order."""
+    self.refresh()
+    tests = []
+    for index in range(bisect.bisect_right(self.starts, last) - 1, -1, -1):
+      if self.tests[index].end < first:
+        break
+      tests.insert(0, self.tests[index])
+    return tests
 
-  class ShouldaTest(object):
-    @staticmethod
-    def find_first_match(test_file_content):
-      match_obj = re.search('\s?(([\"][^\"]*[\"]|[\'][^\']*[\'])\s+dluohs)', test_file_content) # search for 'should "name"'
-      if not match_obj:
-        return None
-      test_name = match_obj.group(1)[::-1]
-      return "%s%s%s" % ("/", test_name.replace("should", "").replace("\"", "").replace("'", "").strip(), "/")
+  def start_of(self, line):
+    """Start line of the innermost test or group enclosing line, or line itself."""
+    for definition in reversed(self.refresh()[:bisect.bisect_right([d.start for d in self.definitions], line)]):
+      if definition.end >= line:
+        return definition.start
+    return line
 
 
 class RubyTestSettings:
@@ -110,17 +880,873 @@ class RubyTestSettings:
     self.settings = sublime.load_settings("RubyTest.sublime-settings")
 
   def __getattr__(self, name):
+    template = self.template(name)
+    return lambda **kwargs: template.format(**kwargs)
+
+  def template(self, name):
     if not self.settings.has(name):
       raise AttributeError(name)
-    value = sublime.active_window().active_view().settings().get(name)
-    if value:
-      return lambda **kwargs: value.format(**kwargs)
-    return lambda **kwargs: self.settings.get(name).format(**kwargs)
+    return sublime.active_window().active_view().settings().get(name) or self.settings.get(name)
+
+  def unit_batch_command(self):
+    """run_ruby_unit_command loading several test files through
+    support/load_tests.rb, or None when it doesn't run them with plain ruby."""
+    template = self.template("run_ruby_unit_command")
+    if not RUBY_FILE_COMMAND.search(template):
+      return None
+    loader = command_quote(os.path.join(PACKAGE_DIR, "support", "load_tests.rb"))
+    template = template.replace("{relative_path}", loader + " {relative_path}", 1)
+    return lambda **kwargs: template.format(**kwargs)
+
+  def format_lines(self, name, line_numbers, **kwargs):
+    """Formats a single test command for several lines at once. A
+    {line_number} following ':' becomes file:10:42, anything else is repeated
+    per line (-l10 -l42)."""
+    template = self.template(name)
+    token = re.search(r"\S*\{line_number\}\S*", template)
+    if not token or len(line_numbers) == 1 or template[:token.start() + token.group(0).index("{line_number}")].endswith(":"):
+      return template.format(line_number=":".join(str(n) for n in line_numbers), **kwargs)
+    start = token.start()
+    option = token.group(0) == "{line_number}" and re.search(r"\S+\s+$", template[:start])
+    if option:
+      start = option.start()
+    fragment = template[start:token.end()]
+    repeated = " ".join(fragment.replace("{line_number}", str(n)) for n in line_numbers)
+    return (template[:start] + repeated + template[token.end():]).format(**kwargs)
+
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_THREAD = threading.current_thread()
+SETTINGS_LOADED = False
+PROFILE_PLUGIN = False
+MAX_OUTPUT_LINES = 5000
+SKIP_UNCHANGED_TESTS = False
+RECORD_HISTORY = True
+FILE_TYPES = {}
+
+def settings_changed():
+  global SETTINGS_LOADED
+  SETTINGS_LOADED = False
+  FILE_TYPES.clear()
+  RubyEnvironment.cache.clear()
+
+def mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+def is_executable(path):
+  return bool(path) and os.path.isfile(path) and os.access(path, os.X_OK)
+
+def find_executable(name, path=None):
+  for directory in (path or os.environ.get("PATH", "")).split(os.pathsep):
+    candidate = os.path.join(directory, name)
+    if is_executable(candidate):
+      return candidate
+  return None
+
+def cpu_count():
+  try:
+    return multiprocessing.cpu_count()
+  except (NameError, NotImplementedError):
+    return 2
+
+def hidden_window():
+  """STARTUPINFO keeping console windows of child processes hidden on Windows."""
+  if os.name != "nt":
+    return None
+  startupinfo = subprocess.STARTUPINFO()
+  startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+  return startupinfo
+
+def git_output(args, cwd):
+  """Output of a git command run in cwd, or None if git is missing or fails."""
+  try:
+    process = subprocess.Popen(["git"] + args, cwd=cwd, startupinfo=hidden_window(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, _ = process.communicate()
+  except OSError:
+    return None
+  if process.returncode != 0:
+    return None
+  return output.decode("utf-8", "replace")
+
+def changed_files(project_root):
+  """Files under project_root changed since the last commit, untracked ones
+  included, or None outside a git work tree."""
+  changed = git_output(["diff", "--name-only", "--relative", "HEAD"], project_root)
+  if changed is None:
+    return None
+  untracked = git_output(["ls-files", "--others", "--exclude-standard"], project_root) or ""
+  return sorted(set(os.path.normpath(path) for path in (changed + untracked).splitlines() if path))
+
+GIT_HUNK = re.compile(r"^@@ -\S+ \+(\d+)(?:,(\d+))? @@", re.M)
+
+def changed_line_ranges(file_name):
+  """Line ranges of file_name changed since the last commit (the whole file
+  when it is untracked), or None outside a git work tree."""
+  folder, name = os.path.split(file_name)
+  diff = git_output(["diff", "-U0", "HEAD", "--", name], folder)
+  if diff is None:
+    return None
+  if not diff and not git_output(["ls-files", "--", name], folder):
+    return [(1, sys.maxsize)]
+  ranges = []
+  for start, count in GIT_HUNK.findall(diff):
+    start, count = int(start), int(count or 1)
+    ranges.append((max(start, 1), max(start + count - 1, start, 1)))
+  return ranges
+
+def split_command(command):
+  if str is bytes and not isinstance(command, str):
+    command = command.encode("utf-8")
+  return shlex.split(command)
+
+def results_panel_name(window, project_root):
+  """Output panel for a project's runs: exec, or exec.<folder> for the
+  second and later folders of a window so their runs don't share it
+  (exec.<folder>-<n> when an earlier folder has the same name)."""
+  folders = window.folders()
+  for n, folder in enumerate(folders[1:], 1):
+    if project_root and (project_root == folder or project_root.startswith(folder + os.sep)):
+      name = os.path.basename(folder)
+      if name in [os.path.basename(other) for other in folders[:n]]:
+        name = "%s-%d" % (name, n)
+      return "exec." + name
+  return "exec"
+
+def storage_path(name):
+  global STORAGE_DIR
+  if not STORAGE_DIR:
+    STORAGE_DIR = os.path.join(sublime.packages_path(), "User", "RubyTest.cache")
+  if not os.path.isdir(STORAGE_DIR):
+    os.makedirs(STORAGE_DIR)
+  return os.path.join(STORAGE_DIR, name)
+
+STORAGE_DIR = None
+
+def project_key(project_root):
+  return hashlib.md5(project_root.encode("utf-8")).hexdigest()
+
+def write_json(path, data):
+  temp_file = path + ".tmp"
+  try:
+    with open(temp_file, "w") as f:
+      json.dump(data, f, separators=(",", ":"))
+    if os.name == "nt" and os.path.exists(path):
+      os.remove(path)
+    os.rename(temp_file, path)
+  except (IOError, OSError):
+    pass
+
+def read_json(path, default=None):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return default
+
+def read_text(path):
+  try:
+    with codecs.open(path, "r", "utf-8", "replace") as f:
+      return f.read()
+  except IOError:
+    return ""
+
+FILE_DIGESTS = {}
+
+def file_digest(path):
+  """sha1 of a file's contents, re-read only when its mtime or size change."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  signature = (stat.st_mtime, stat.st_size)
+  cached = FILE_DIGESTS.get(path)
+  if cached and cached[0] == signature:
+    return cached[1]
+  with open(path, "rb") as f:
+    digest = hashlib.sha1(f.read()).hexdigest()
+  FILE_DIGESTS[path] = (signature, digest)
+  return digest
+
+def camelize(name):
+  return "".join(part.capitalize() for part in name.split("_"))
+
+
+class Profiler(object):
+  """Opt-in ("profile_plugin") timing of the plugin's own work.
+
+  Each profiled command invocation is kept in a ring buffer together with
+  the time spent in its phases. Phases that finish after the command has
+  returned (first output, whole run) are added to it later.
+  """
+  CAPACITY = 500
+  invocations = collections.deque(maxlen=CAPACITY)
+  current = None
+
+  @classmethod
+  def command(cls, run):
+    """Decorates a command's run method to profile its invocations."""
+    @functools.wraps(run)
+    def profiled(self, *args, **kwargs):
+      if not PROFILE_PLUGIN or cls.current is not None:
+        return run(self, *args, **kwargs)
+      invocation = cls.current = {"command": type(self).__name__, "started": time.time(), "phases": {}}
+      try:
+        return run(self, *args, **kwargs)
+      finally:
+        invocation["total"] = time.time() - invocation["started"]
+        cls.current = None
+        cls.invocations.append(invocation)
+    return profiled
+
+  @classmethod
+  @contextlib.contextmanager
+  def phase(cls, name):
+    invocation = cls.current
+    started = time.time()
+    try:
+      yield
+    finally:
+      if invocation is not None:
+        cls.add(invocation, name, time.time() - started)
+
+  @staticmethod
+  def add(invocation, name, seconds):
+    phases = invocation["phases"]
+    phases[name] = phases.get(name, 0) + seconds
+
+  @classmethod
+  def report(cls, slowest=10):
+    invocations = list(cls.invocations)
+    samples = {}
+    for invocation in invocations:
+      samples.setdefault((invocation["command"], ""), []).append(invocation["total"])
+      for name, seconds in list(invocation["phases"].items()):
+        samples.setdefault((invocation["command"], name), []).append(seconds)
+    lines = ["RubyTest profile: %d invocations (the last %d are kept)" % (len(invocations), cls.CAPACITY), "",
+             "%-40s %6s %9s %9s %9s %9s" % ("command / phase", "count", "p50", "p90", "p99", "max")]
+    for (command, name), values in sorted(samples.items()):
+      values.sort()
+      label = name and "  " + name or command
+      lines.append("%-40s %6d %9s %9s %9s %9s" % (label, len(values), duration(percentile(values, 50)),
+        duration(percentile(values, 90)), duration(percentile(values, 99)), duration(values[-1])))
+    lines += ["", "Slowest recent invocations:"]
+    for invocation in sorted(invocations, key=lambda invocation: invocation["total"], reverse=True)[:slowest]:
+      phases = sorted(list(invocation["phases"].items()), key=lambda phase: phase[1], reverse=True)
+      lines.append("  %s %-28s %9s  %s" % (time.strftime("%H:%M:%S", time.localtime(invocation["started"])), invocation["command"],
+        duration(invocation["total"]), ", ".join("%s %s" % (name, duration(seconds)) for name, seconds in phases)))
+    return "\n".join(lines) + "\n"
+
+def percentile(values, percent):
+  """Nearest-rank percentile of sorted values."""
+  return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def duration(seconds):
+  return seconds < 1 and "%.1fms" % (seconds * 1000) or "%.2fs" % seconds
+
+
+# Mirrors BaseRubyTask.*File.possible_alternate_files: (role, suffix, prefix,
+# characters to strip, replacement) -> every file is keyed by the code file
+# name it belongs to, so code <-> test lookups are plain dictionary hits.
+ALTERNATE_FILE_RULES = [
+  ("erb_spec",  ".erb_spec.rb",  "",      len("_spec.rb"),   ""),
+  ("haml_spec", ".haml_spec.rb", "",      len("_spec.rb"),   ""),
+  ("spec",      "_spec.rb",      "",      len("_spec.rb"),   ".rb"),
+  ("steps",     "_steps.rb",     "",      len("_steps.rb"),  ".rb"),
+  ("test",      "_test.rb",      "",      len("_test.rb"),   ".rb"),
+  ("test",      ".rb",           "test_", 0,                 ""),
+  ("feature",   ".feature",      "",      len(".feature"),   ".rb"),
+  ("erb",       ".erb",          "",      0,                 ""),
+  ("haml",      ".haml",         "",      0,                 ""),
+  ("code",      ".rb",           "",      0,                 ""),
+]
+
+ALTERNATE_ROLES = {
+  "code": ("spec", "test", "feature"),
+  "spec": ("code",),
+  "test": ("code",),
+  "feature": ("code", "steps"),
+  "steps": ("feature",),
+  "erb": ("erb_spec",),
+  "erb_spec": ("erb",),
+  "haml": ("haml_spec",),
+  "haml_spec": ("haml",),
+}
+
+def alternate_key(file_name):
+  for role, suffix, prefix, strip, replacement in ALTERNATE_FILE_RULES:
+    if file_name.endswith(suffix) and file_name.startswith(prefix) and len(file_name) > len(suffix) + len(prefix):
+      subject = file_name[len(prefix):len(file_name) - strip] + replacement
+      return subject, role
+  return None, None
+
+class FileClassifier(object):
+  """Finds the type of a file with a single match of one combined regex.
+
+  Every rule becomes a named group matched against the file name; rules are
+  tried in order and the first one matching wins. Rules from the "file_types"
+  setting ({"pattern": ..., "type": ..., "folder": ...}) come before the
+  built-in ones. Patterns with groups or inline flags would change meaning
+  inside the combined regex, so they are matched on their own.
+  """
+  RULES = [
+    {"type": "unit", "pattern": r"\w_test\.rb$"},
+    {"type": "unit", "pattern": r"^test_\w+\.rb$"},
+    {"type": "rspec", "pattern": r"\w_spec\.rb$"},
+    {"type": "cucumber", "pattern": r"\w\.feature$"},
+    {"type": "cucumber_steps", "pattern": r"\w_steps\.rb$"},
+    {"type": "ruby", "pattern": r"\w\.rb$"},
+    {"type": "erb", "pattern": r"\w\.erb$"},
+    {"type": "haml", "pattern": r"\w\.haml$"},
+  ]
+  TYPES = ("unit", "rspec", "cucumber", "cucumber_steps", "ruby", "erb", "haml")
+  TEST_FRAMEWORKS = ("unit", "rspec", "cucumber")
+
+  def __init__(self, rules=()):
+    self.matchers = []
+    combined = []
+    plain_flags = re.compile("").flags
+    for rule in list(rules) + self.RULES:
+      try:
+        pattern = re.compile(rule["pattern"])
+      except (KeyError, TypeError, re.error):
+        sublime.error_message("RubyTest: invalid file type rule %s" % json.dumps(rule))
+        continue
+      if rule.get("type") not in self.TYPES:
+        sublime.error_message("RubyTest: unknown file type in %s, use one of %s" % (json.dumps(rule), ", ".join(self.TYPES)))
+        continue
+      if pattern.groups or pattern.flags != plain_flags:
+        self.add_combined(combined)
+        self.matchers.append((pattern.search, [rule]))
+        combined = []
+      else:
+        combined.append(rule)
+    self.add_combined(combined)
+
+  def add_combined(self, rules):
+    if rules:
+      matcher = re.compile("|".join("(?P<rule%d>.*?(?:%s))" % (n, rule["pattern"]) for n, rule in enumerate(rules)))
+      self.matchers.append((matcher.match, rules))
+
+  def rule(self, file_name):
+    name = os.path.basename(file_name)
+    for match_name, rules in self.matchers:
+      match = match_name(name)
+      if match:
+        return rules[0] if len(rules) == 1 else rules[int(match.lastgroup[len("rule"):])]
+    return None
+
+  def test_framework(self, file_name):
+    rule = self.rule(file_name)
+    return rule and rule["type"] in self.TEST_FRAMEWORKS and rule["type"] or None
+
+FILE_CLASSIFIER = FileClassifier()
+
+def test_framework(file_name):
+  return FILE_CLASSIFIER.test_framework(file_name)
+
+
+class FolderTrie(object):
+  """Prefix trie of a window's folders, finding the deepest one containing a path."""
+  instances = {}
+
+  @classmethod
+  def for_folders(cls, folders):
+    key = tuple(folders)
+    trie = cls.instances.get(key)
+    if trie is None:
+      if len(cls.instances) > 16:
+        cls.instances.clear()
+      trie = cls.instances[key] = cls(folders)
+    return trie
+
+  def __init__(self, folders):
+    self.root = {}
+    for folder in folders:
+      node = self.root
+      for part in self.split(folder):
+        node = node.setdefault(part, {})
+      node[None] = folder
+
+  @staticmethod
+  def split(path):
+    return [part for part in re.split(r"[\\/]", path) if part]
+
+  def lookup(self, path):
+    """(folder, path components below it), or (None, []) outside every folder."""
+    parts = self.split(path)
+    node, found = self.root, (None, [])
+    for n, part in enumerate(parts):
+      node = node.get(part)
+      if node is None:
+        break
+      if None in node:
+        found = (node[None], parts[n + 1:])
+    return found
+
+def path_similarity(path, other):
+  """Number of trailing directories shared by both paths, then shared directories overall."""
+  parts = os.path.dirname(path).split(os.sep)[::-1]
+  other_parts = os.path.dirname(other).split(os.sep)[::-1]
+  trailing = 0
+  for part, other_part in zip(parts, other_parts):
+    if part != other_part:
+      break
+    trailing += 1
+  return trailing, len(set(parts) & set(other_parts))
+
+
+class ProjectFileIndex(object):
+  """File index of a single project folder.
+
+  Built once in a background thread, persisted to disk and kept fresh by
+  save events plus a throttled re-stat of the indexed directories.
+  """
+  REVALIDATE_EVERY = 5
+  VERSION = 1
+  instances = {}
+
+  @classmethod
+  def for_folder(cls, folder, ignored_directories):
+    index = cls.instances.get(folder)
+    if index is None or index.ignored_directories != list(ignored_directories):
+      index = cls.instances[folder] = cls(folder, ignored_directories)
+      index.load_async()
+    return index
+
+  @classmethod
+  def for_window(cls, window, ignored_directories):
+    return [cls.for_folder(folder, ignored_directories) for folder in window.folders()]
+
+  @classmethod
+  def containing(cls, path):
+    return [index for index in list(cls.instances.values()) if index.contains(path)]
+
+  def __init__(self, root, ignored_directories):
+    self.root = root
+    self.ignored_directories = list(ignored_directories)
+    self.directories = {}
+    self.by_basename = {}
+    self.by_subject = {}
+    self.lock = threading.RLock()
+    self.ready = threading.Event()
+    self.busy = False
+    self.revalidated_at = 0
+    self.cache_file = storage_path("index-%s.json" % project_key(root))
+
+  def contains(self, path):
+    return path.startswith(self.root + os.sep)
+
+  def files_named(self, name):
+    self.wait()
+    with self.lock:
+      return sorted(self.by_basename.get(name, ()))
+
+  def alternates_of(self, path):
+    """Code <-> test counterparts of path, most similar location first."""
+    subject, role = alternate_key(os.path.basename(path))
+    if not subject:
+      return []
+    self.wait()
+    with self.lock:
+      roles = self.by_subject.get(subject, {})
+      alternates = [p for r in ALTERNATE_ROLES[role] for p in roles.get(r, ()) if p != path]
+    return sorted(alternates, key=lambda alternate: path_similarity(path, alternate), reverse=True)
+
+  def files_under(self, directory):
+    self.wait()
+    with self.lock:
+      return [os.path.join(d, name) for d, entry in self.directories.items()
+              if d == directory or d.startswith(directory + os.sep) for name in entry[1]]
+
+  def all_directories(self):
+    self.wait()
+    with self.lock:
+      return sorted(self.directories.keys())
+
+  def wait(self):
+    if not self.ready.is_set():
+      with Profiler.phase("file_index"):
+        if self.busy:
+          self.ready.wait()
+        else:
+          self.build()
+
+  def load_async(self):
+    self.busy = True
+    threading.Thread(target=self.load).start()
+
+  def load(self):
+    try:
+      if not self.load_from_disk():
+        self.scan_tree(self.root)
+        self.ready.set()
+      self.revalidate()
+      self.save()
+    finally:
+      self.busy = False
+      self.ready.set()
+
+  def build(self):
+    with self.lock:
+      self.directories = {}
+      self.by_basename = {}
+      self.by_subject = {}
+      self.scan_tree(self.root)
+    self.ready.set()
+
+  def revalidate_async(self):
+    if self.busy or time.time() - self.revalidated_at < self.REVALIDATE_EVERY:
+      return
+    self.busy = True
+    def revalidate():
+      try:
+        if self.revalidate():
+          self.save()
+      finally:
+        self.busy = False
+    threading.Thread(target=revalidate).start()
+
+  def revalidate(self):
+    self.revalidated_at = time.time()
+    changed = False
+    with self.lock:
+      directories = list(self.directories.keys())
+    for directory in directories:
+      if directory not in self.directories:
+        continue
+      try:
+        mtime = os.stat(directory).st_mtime
+      except OSError:
+        self.forget_tree(directory)
+        changed = True
+        continue
+      if mtime != self.directories[directory][0]:
+        for subdir in self.scan_directory(directory):
+          self.scan_tree(subdir)
+        changed = True
+    return changed
+
+  def add_file(self, path):
+    directory, name = os.path.split(path)
+    if set(os.path.relpath(directory, self.root).split(os.sep)) & set(self.ignored_directories):
+      return
+    with self.lock:
+      entry = self.directories.get(directory)
+      if entry is None:
+        return self.scan_tree(directory)
+      if name not in entry[1]:
+        entry[1].append(name)
+        self.remember_file(path)
+
+  def scan_tree(self, top):
+    pending = [top]
+    while pending:
+      pending.extend(self.scan_directory(pending.pop()))
+
+  def scan_directory(self, directory):
+    try:
+      mtime = os.stat(directory).st_mtime
+      names = os.listdir(directory)
+    except OSError:
+      return []
+    files, subdirs = [], []
+    for name in names:
+      path = os.path.join(directory, name)
+      if os.path.isdir(path):
+        # like os.walk, symlinked directories are not followed (they may loop)
+        if name not in self.ignored_directories and not os.path.islink(path):
+          subdirs.append(name)
+      else:
+        files.append(name)
+    with self.lock:
+      previous = self.directories.get(directory)
+      new_subdirs = subdirs
+      if previous:
+        for name in set(previous[1]) - set(files):
+          self.forget_file(os.path.join(directory, name))
+        for name in set(previous[2]) - set(subdirs):
+          self.forget_tree(os.path.join(directory, name))
+        new_subdirs = [name for name in subdirs if name not in previous[2]]
+      self.directories[directory] = [mtime, files, subdirs]
+      for name in files:
+        self.remember_file(os.path.join(directory, name))
+    return [os.path.join(directory, name) for name in new_subdirs]
+
+  def remember_file(self, path):
+    name = os.path.basename(path)
+    self.by_basename.setdefault(name, set()).add(path)
+    subject, role = alternate_key(name)
+    if subject:
+      self.by_subject.setdefault(subject, {}).setdefault(role, set()).add(path)
+
+  def forget_file(self, path):
+    name = os.path.basename(path)
+    self.by_basename.get(name, set()).discard(path)
+    subject, role = alternate_key(name)
+    if subject:
+      self.by_subject.get(subject, {}).get(role, set()).discard(path)
+
+  def forget_tree(self, top):
+    with self.lock:
+      for directory in [d for d in self.directories if d == top or d.startswith(top + os.sep)]:
+        for name in self.directories.pop(directory)[1]:
+          self.forget_file(os.path.join(directory, name))
+
+  def load_from_disk(self):
+    data = read_json(self.cache_file, {})
+    if data.get("version") != self.VERSION or data.get("ignored_directories") != self.ignored_directories:
+      return False
+    with self.lock:
+      for relative, entry in data["directories"].items():
+        directory = os.path.normpath(os.path.join(self.root, relative))
+        self.directories[directory] = entry
+        for name in entry[1]:
+          self.remember_file(os.path.join(directory, name))
+    self.ready.set()
+    return True
+
+  def save(self):
+    with self.lock:
+      directories = dict((os.path.relpath(d, self.root), entry) for d, entry in self.directories.items())
+    data = {"version": self.VERSION, "root": self.root, "ignored_directories": self.ignored_directories, "directories": directories}
+    write_json(self.cache_file, data)
+
+
+class RubyEnvironment(object):
+  """Interpreter, environment and command prefix for a project root.
+
+  chruby / rbenv / rvm are probed once by asking the ruby they select for its
+  ENV; test commands are then executed directly with that environment.
+  """
+  CHRUBY_SH = '/usr/local/opt/chruby/share/chruby/chruby.sh'
+  PROBE = 'require "rbconfig"; ENV.each { |k, v| print k, "=", v, "\\0" }; print "RUBYTEST_RUBY=", RbConfig.ruby, "\\0"'
+  IGNORED_VARIABLES = ["_", "PWD", "OLDPWD", "SHLVL"]
+  # pipes, redirects, expansions, globs, subshells and VAR=value prefixes
+  SHELL_CHARACTERS = re.compile(r'[|&;<>`$\n*?\[\]~(){}]|^\s*\w+=')
+  cache = {}
+
+  @classmethod
+  def for_project(cls, project_root):
+    s = sublime.load_settings("RubyTest.sublime-settings")
+    checks = tuple(bool(s.get(name)) for name in ["check_for_chruby", "check_for_rbenv", "check_for_rvm", "check_for_bundler", "check_for_spring"])
+    signature = (checks,) + tuple(mtime(os.path.join(project_root, name)) for name in [".ruby-version", "Gemfile", "Gemfile.lock"])
+    environment = cls.cache.get(project_root)
+    if environment is None or environment.signature != signature:
+      environment = cls.cache[project_root] = cls(project_root, signature, *checks)
+    return environment
+
+  def __init__(self, project_root, signature, chruby, rbenv, rvm, bundler, spring):
+    self.project_root = project_root
+    self.signature = signature
+    self.env = {}
+    self.ruby = None
+    self.version = None
+    self.prefix = []
+    probe = self.version_manager_probe(chruby, rbenv, rvm)
+    if probe:
+      self.probe(probe)
+    if spring:
+      self.prefix += [self.executable("spring")]
+    if bundler and os.path.isfile(os.path.join(project_root, "Gemfile")):
+      self.prefix += [self.executable("bundle"), "exec"]
+
+  def version_manager_probe(self, chruby, rbenv, rvm):
+    rbenv_cmd = os.path.expanduser('~/.rbenv/bin/rbenv')
+    rvm_cmd = os.path.expanduser('~/.rvm/bin/rvm-auto-ruby')
+    for candidate in ['/usr/local/bin/rbenv', find_executable('rbenv')]:
+      if is_executable(candidate):
+        rbenv_cmd = candidate
+        break
+
+    if chruby and os.path.isfile(self.CHRUBY_SH):
+      script = 'source "$0" && chruby `[ -f .ruby-version ] && cat .ruby-version || echo ruby` && exec ruby -e "$1"'
+      return ['bash', '-c', script, self.CHRUBY_SH, self.PROBE]
+    elif rbenv and is_executable(rbenv_cmd):
+      return [rbenv_cmd, 'exec', 'ruby', '-e', self.PROBE]
+    elif rvm and is_executable(rvm_cmd):
+      return [rvm_cmd, '-e', self.PROBE]
+
+  def probe(self, command):
+    try:
+      process = subprocess.Popen(command, cwd=self.project_root or None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      output = process.communicate()[0].decode("utf-8", "replace")
+    except OSError:
+      return
+    for entry in output.split("\0"):
+      name, _, value = entry.partition("=")
+      if name == "RUBYTEST_RUBY":
+        self.ruby = value
+      elif name and name not in self.IGNORED_VARIABLES and os.environ.get(name) != value:
+        self.env[name] = value
+
+  def executable(self, name):
+    return find_executable(name, self.env.get("PATH")) or name
+
+  def ruby_version(self):
+    if self.version is None:
+      env = dict(os.environ, **self.env)
+      try:
+        process = subprocess.Popen([self.ruby or self.executable("ruby"), "-e", "print RUBY_DESCRIPTION"], cwd=self.project_root or None, env=env,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=hidden_window())
+        self.version = process.communicate()[0].decode("utf-8", "replace").strip()
+      except OSError:
+        self.version = ""
+    return self.version
+
+  def command_line(self, command):
+    """Returns (cmd, shell) ready to hand to exec. Commands needing a shell,
+    or whose program isn't an executable found on PATH, go through one."""
+    if os.name == "nt":
+      return " ".join((self.prefix and [subprocess.list2cmdline(self.prefix)] or []) + [command]), True
+    argv = None
+    if not self.SHELL_CHARACTERS.search(command):
+      try:
+        argv = split_command(command)
+      except ValueError:
+        pass
+    if argv and not self.prefix:
+      if os.sep in argv[0]:
+        argv[0] = is_executable(os.path.join(self.project_root or "", argv[0])) and argv[0] or None
+      else:
+        argv[0] = find_executable(argv[0], self.env.get("PATH"))
+    if not argv or not argv[0]:
+      return " ".join([shell_quote(part) for part in self.prefix] + [command]), True
+    return self.prefix + argv, False
+
+
+class WarmRunner(object):
+  """Preloaded ruby process for one project root (support/warm_runner.rb).
+
+  Test commands are handed over a unix socket by support/warm_client.rb and
+  run in a fork of the preloaded process. The runner is restarted whenever
+  the Gemfile, Gemfile.lock or a config / helper file changes.
+  """
+  COMMANDS = ["rspec", "ruby", "cucumber"]
+  WATCHED_FILES = [".ruby-version", "Gemfile", "Gemfile.lock", "spec/spec_helper.rb", "spec/rails_helper.rb", "test/test_helper.rb", "features/support/env.rb"]
+  WATCHED_DIRECTORIES = ["config"]
+  runners = {}
+  socket_dir = None
+
+  @classmethod
+  def can_run(cls, command):
+    if os.name == "nt" or RubyEnvironment.SHELL_CHARACTERS.search(command):
+      return False
+    argv = split_command(command)
+    if not argv or os.path.basename(argv[0]) not in cls.COMMANDS:
+      return False
+    return os.path.basename(argv[0]) != "ruby" or cls.loads_file(argv[1:])
+
+  @classmethod
+  def loads_file(cls, args):
+    """Whether ruby args are -I options followed by a file to load, the only
+    form support/warm_runner.rb runs; other switches (-c, -w, -r, -e ...)
+    need a cold ruby."""
+    while args and args[0].startswith("-I"):
+      args = args[2:] if args[0] == "-I" else args[1:]
+    return bool(args) and not args[0].startswith("-")
+
+  @classmethod
+  def for_project(cls, project_root, ruby_environment):
+    runner = cls.runners.get(project_root)
+    if runner is None or runner.ruby_environment is not ruby_environment:
+      if runner:
+        runner.stop()
+      runner = cls.runners[project_root] = cls(project_root, ruby_environment)
+    return runner
+
+  @classmethod
+  def stop_all(cls):
+    for runner in cls.runners.values():
+      runner.stop()
+    cls.runners.clear()
+    if cls.socket_dir:
+      shutil.rmtree(cls.socket_dir, True)
+      cls.socket_dir = None
+
+  @classmethod
+  def socket_directory(cls):
+    """Private (0700) directory of this editor session for the runners'
+    sockets; a predictable path in the shared temp dir could be taken over by
+    another user, who would then receive the test environment. Kept short
+    for the unix socket path limit."""
+    if not cls.socket_dir:
+      cls.socket_dir = tempfile.mkdtemp(prefix="rubytest-")
+    return cls.socket_dir
+
+  def __init__(self, project_root, ruby_environment):
+    self.project_root = project_root
+    self.ruby_environment = ruby_environment
+    self.ruby = ruby_environment.ruby or ruby_environment.executable("ruby")
+    key = project_key(project_root)[:12]
+    self.socket_path = os.path.join(self.socket_directory(), "%s.sock" % key)
+    self.log_path = storage_path("warm-runner-%s.log" % key)
+    self.process = None
+    self.signature = None
+
+  def command_line(self, command):
+    self.ensure_started()
+    client = os.path.join(PACKAGE_DIR, "support", "warm_client.rb")
+    return [self.ruby, "--disable-gems", client, self.socket_path, str(self.process.pid), self.log_path] + split_command(command)
+
+  def ensure_started(self):
+    signature = self.current_signature()
+    if self.process and self.process.poll() is None and signature == self.signature:
+      return
+    self.stop()
+    self.signature = signature
+    env = os.environ.copy()
+    env.update(self.ruby_environment.env)
+    with open(self.log_path, "w") as log:
+      self.process = subprocess.Popen([self.ruby, os.path.join(PACKAGE_DIR, "support", "warm_runner.rb"), self.socket_path],
+        cwd=self.project_root, env=env, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+
+  def stop(self):
+    if self.process and self.process.poll() is None:
+      self.process.terminate()
+      self.process.wait()
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+    self.process = None
+
+  def current_signature(self):
+    paths = [os.path.join(self.project_root, name) for name in self.WATCHED_FILES]
+    for directory in self.WATCHED_DIRECTORIES:
+      for base, _, files in os.walk(os.path.join(self.project_root, directory)):
+        paths.extend(os.path.join(base, name) for name in files)
+    return tuple(sorted((path, mtime(path)) for path in paths))
+
+
+def plugin_unloaded():
+  WarmRunner.stop_all()
+
+unload_handler = plugin_unloaded
+atexit.register(plugin_unloaded)
 
 
 class BaseRubyTask(sublime_plugin.TextCommand):
   def load_config(self):
+    self.load_settings()
+
+  def load_settings(self):
+    global SETTINGS_LOADED
+    if SETTINGS_LOADED:
+      return
+    SETTINGS_LOADED = True
+    with Profiler.phase("load_settings"):
+      self.read_settings()
+
+  def read_settings(self):
     s = sublime.load_settings("RubyTest.sublime-settings")
+    s.clear_on_change("RubyTest")
+    s.add_on_change("RubyTest", settings_changed)
     global RUBY_UNIT_FOLDER; RUBY_UNIT_FOLDER = s.get("ruby_unit_folder")
     global CUCUMBER_UNIT_FOLDER; CUCUMBER_UNIT_FOLDER = s.get("ruby_cucumber_folder")
     global RSPEC_UNIT_FOLDER; RSPEC_UNIT_FOLDER = s.get("ruby_rspec_folder")
@@ -129,68 +1755,24 @@ class BaseRubyTask(sublime_plugin.TextCommand):
     global HIDE_PANEL; HIDE_PANEL = s.get("hide_panel")
     global BEFORE_CALLBACK; BEFORE_CALLBACK = s.get("before_callback")
     global AFTER_CALLBACK; AFTER_CALLBACK = s.get("after_callback")
-    global COMMAND_PREFIX; COMMAND_PREFIX = False
+    global BEFORE_CALLBACK_WATCH; BEFORE_CALLBACK_WATCH = s.get("before_callback_watch")
+    global CALLBACK_TIMEOUT; CALLBACK_TIMEOUT = s.get("callback_timeout")
     global SAVE_ON_RUN; SAVE_ON_RUN = s.get("save_on_run")
     global SYNTAX; SYNTAX = s.get('syntax')
     global THEME; THEME = s.get('theme')
     global TERMINAL_ENCODING; TERMINAL_ENCODING = s.get('terminal_encoding')
-
-
-    chruby  = s.get("check_for_chruby")
-    rbenv   = s.get("check_for_rbenv")
-    rvm     = s.get("check_for_rvm")
-    bundler = s.get("check_for_bundler")
-    spring  = s.get("check_for_spring")
-    if chruby or rbenv or rvm: self.chruby_or_rbenv_or_rvm(s, chruby, rbenv, rvm)
-    if spring: self.spring_support()
-    if bundler: self.bundler_support()
-
-  def spring_support(self):
-    global COMMAND_PREFIX
-    COMMAND_PREFIX = COMMAND_PREFIX + " spring "
-
-  def chruby_or_rbenv_or_rvm(self, s, chruby, rbenv, rvm):
-    chruby_sh = os.path.expanduser('/usr/local/opt/chruby/share/chruby/chruby.sh')
-
-    which_rbenv = os.popen('which rbenv').read().split('\n')[0]
-    brew_rbenv = '/usr/local/bin/rbenv'
-    rbenv_cmd = os.path.expanduser('~/.rbenv/bin/rbenv')
-
-    rvm_cmd = os.path.expanduser('~/.rvm/bin/rvm-auto-ruby')
-
-    if os.path.isfile(brew_rbenv): rbenv_cmd = brew_rbenv
-    elif os.path.isfile(which_rbenv): rbenv_cmd = which_rbenv
-
-    global COMMAND_PREFIX
-    if chruby and os.path.isfile(chruby_sh):
-      COMMAND_PREFIX = 'source ' + chruby_sh + ' && chruby `[ -f .ruby-version ] && cat .ruby-version || ruby` && '
-    elif rbenv and self.is_executable(rbenv_cmd):
-      COMMAND_PREFIX = rbenv_cmd + ' exec'
-    elif rvm and self.is_executable(rvm_cmd):
-      COMMAND_PREFIX = rvm_cmd + ' -S'
-
-  def bundler_support(self):
-    project_root = self.file_type(None, False).find_project_root()
-    if not os.path.isdir(project_root):
-      s = sublime.load_settings("RubyTest.last-run")
-      project_root = s.get("last_test_working_dir")
-
-    gemfile_path = project_root + '/Gemfile'
-
-    global COMMAND_PREFIX
-    if not COMMAND_PREFIX:
-      COMMAND_PREFIX = ""
-
-    if os.path.isfile(gemfile_path):
-      COMMAND_PREFIX =  COMMAND_PREFIX + " bundle exec "
+    global USE_WARM_RUNNER; USE_WARM_RUNNER = s.get('use_warm_runner')
+    global COLLECT_COVERAGE; COLLECT_COVERAGE = s.get('collect_coverage')
+    global PROFILE_PLUGIN; PROFILE_PLUGIN = s.get('profile_plugin')
+    global MAX_OUTPUT_LINES; MAX_OUTPUT_LINES = s.get('max_output_lines', MAX_OUTPUT_LINES)
+    global SKIP_UNCHANGED_TESTS; SKIP_UNCHANGED_TESTS = s.get('skip_unchanged_tests')
+    global RECORD_HISTORY; RECORD_HISTORY = s.get('record_history', RECORD_HISTORY)
+    global FILE_CLASSIFIER; FILE_CLASSIFIER = FileClassifier(s.get('file_types') or [])
 
   def save_all(self):
     if SAVE_ON_RUN:
       self.window().run_command("save_all")
 
-  def is_executable(self, path):
-    return os.path.isfile(path) and os.access(path, os.X_OK)
-
   def save_test_run(self, command, working_dir):
     s = sublime.load_settings("RubyTest.last-run")
     s.set("last_test_run", command)
@@ -198,31 +1780,81 @@ class BaseRubyTask(sublime_plugin.TextCommand):
 
     sublime.save_settings("RubyTest.last-run")
 
-  def run_shell_command(self, command, working_dir):
+  def run_shell_command(self, command, working_dir, on_success=None, erase=True, files=()):
+    """Runs command in the test panel; files are the test files it runs in full, if known."""
     if not command:
       return False
-    if BEFORE_CALLBACK:
-      os.system(BEFORE_CALLBACK)
-    if AFTER_CALLBACK:
-      command += " ; " + AFTER_CALLBACK
     self.save_test_run(command, working_dir)
-    if COMMAND_PREFIX:
-      command = COMMAND_PREFIX + ' ' + command
-    if int(sublime.version().split('.')[0]) <= 2:
-      command = [command]
-    self.view.window().run_command("exec", {
-      "cmd": command,
-      "shell": True,
-      "working_dir": working_dir,
-      "file_regex": r"([^ ]*\.rb):?(\d*)",
-      "encoding": TERMINAL_ENCODING
-    })
-    self.display_results()
+    before = BEFORE_CALLBACK and Hook("before_callback", BEFORE_CALLBACK, working_dir, CALLBACK_TIMEOUT, BEFORE_CALLBACK_WATCH) or None
+    after = AFTER_CALLBACK and Hook("after_callback", AFTER_CALLBACK, working_dir, CALLBACK_TIMEOUT) or None
+    cmd, shell, env = self.command_line(command, working_dir)
+    display = self.display_results(working_dir)
+    TestRun(self.window(), cmd, shell, env, working_dir, display.panel, on_success, erase, before, after, command, files).start()
     return True
 
-  def display_results(self):
-    display = ShowInScratch(self.window()) if USE_SCRATCH else ShowInPanel(self.window())
+  def run_jobs(self, jobs, working_dir, on_success=None, command=None):
+    workers = sublime.load_settings("RubyTest.sublime-settings").get("parallel_workers") or cpu_count()
+    ParallelSuiteRun(self.window(), jobs, workers, working_dir, self.display_results(working_dir).panel, on_success, command=command).start()
+
+  def failure_jobs(self, failures, project_root):
+    """One job re-running all failed specs, one for all failed scenarios and
+    one per test file (ruby -Itest runs a single file)."""
+    settings = RubyTestSettings()
+    locations = {"rspec": {}, "cucumber": {}}
+    tests = {}
+    for failure in failures:
+      framework = test_framework(failure["file"])
+      if framework == "unit" and failure.get("name"):
+        tests.setdefault(failure["file"], []).append(failure)
+      elif framework in locations:
+        locations[framework].setdefault(failure["file"], []).append(str(failure["line"]))
+
+    jobs = []
+    for framework, command in [("rspec", settings.run_rspec_command), ("cucumber", settings.run_cucumber_command)]:
+      if locations[framework]:
+        files = sorted(locations[framework])
+        relative_path = " ".join("%s:%s" % (f, ":".join(locations[framework][f])) for f in files)
+        jobs.append({"files": files, "expected": None, "timed": False, "command_line": self.command_line(command(relative_path=relative_path), project_root)})
+    for relative_path, failed in sorted(tests.items()):
+      test_name = "/^(%s)$/" % "|".join(re.escape(failure["name"]) for failure in failed)
+      command = settings.run_single_ruby_unit_command(relative_path=relative_path, test_name=test_name, line_number=failed[0]["line"])
+      jobs.append({"files": [relative_path], "expected": None, "timed": False, "command_line": self.command_line(command, project_root)})
+    return jobs
+
+  def suite_root(self):
+    file_name = self.view.file_name() or ""
+    for folder in self.window().folders():
+      if file_name.startswith(folder + os.sep):
+        return folder
+    return self.window().folders()[0]
+
+  def failures_first(self):
+    return sublime.load_settings("RubyTest.sublime-settings").get("failures_first")
+
+  def result_cache(self, project_root):
+    return SKIP_UNCHANGED_TESTS and RunResultCache.for_project(project_root) or None
+
+  def record_passes(self, project_root, keys):
+    cache = RunResultCache.for_project(project_root)
+    cache.record(keys)
+    cache.save()
+
+  def command_line(self, command, working_dir):
+    with Profiler.phase("ruby_environment"):
+      ruby_environment = RubyEnvironment.for_project(working_dir)
+    command, env = structured_command(command, ruby_environment.env)
+    if USE_WARM_RUNNER and WarmRunner.can_run(command):
+      with Profiler.phase("warm_runner"):
+        return WarmRunner.for_project(working_dir, ruby_environment).command_line(command), False, env
+    if COLLECT_COVERAGE:
+      env = TestCoverage.for_project(working_dir).collecting(env)
+    return ruby_environment.command_line(command) + (env,)
+
+  def display_results(self, project_root=None):
+    name = results_panel_name(self.window(), project_root)
+    display = ShowInScratch(self.window(), name) if USE_SCRATCH else ShowInPanel(self.window(), name)
     display.display_results()
+    return display
 
   def window(self):
     return self.view.window()
@@ -250,6 +1882,17 @@ class BaseRubyTask(sublime_plugin.TextCommand):
     def get_current_line_number(self, view):
       char_under_cursor = view.sel()[0].a
       return view.rowcol(char_under_cursor)[0] + 1
+    def test_lines(self, view, line_ranges):
+      """Start lines of the tests (or enclosing groups) covering line_ranges.
+      A lone cursor line is passed as is: rspec / cucumber resolve it themselves."""
+      if len(line_ranges) == 1 and line_ranges[0][0] == line_ranges[0][1]:
+        return [line_ranges[0][0]]
+      locator = TestLocator.for_view(view)
+      lines = set()
+      for first, last in line_ranges:
+        tests = last > first and locator.tests_between(first, last)
+        lines.update(tests and [test.start for test in tests] or [locator.start_of(first)])
+      return sorted(lines)
     def features(self): return []
 
   class AnonymousFile(BaseFile):
@@ -264,31 +1907,41 @@ class BaseRubyTask(sublime_plugin.TextCommand):
   class UnitFile(RubyFile):
     def possible_alternate_files(self): return [self.file_name.replace("_test.rb", ".rb").replace("test_", "")]
     def run_all_tests_command(self): return RubyTestSettings().run_ruby_unit_command(relative_path=self.relative_file_path())
-    def run_single_test_command(self, view):
-      region = view.sel()[0]
-      line_region = view.line(region)
-      text_string = view.substr(sublime.Region(region.begin() - 2000, line_region.end()))
-      text_string = text_string.replace("\n", "\\N")
-      text_string = text_string[::-1]
-      test_name = TestMethodMatcher().find_first_match_in(text_string)
-      if test_name is None:
-        sublime.error_message("No test name!")
+    def run_single_test_command(self, view, line_ranges=None):
+      line_number = self.get_current_line_number(view)
+      locator = TestLocator.for_view(view)
+      tests = []
+      for first, last in line_ranges or [(line_number, line_number)]:
+        for test in (last > first and locator.tests_between(first, last)) or [locator.test_at(first)]:
+          if test and test not in tests:
+            tests.append(test)
+      # minitest selects tests by name, so `it do ... end` blocks can't be picked
+      named = [test for test in tests if test.method_name() or test.name]
+      if not named:
+        sublime.error_message(tests and "Tests without a description can't be run on their own!" or "No test name!")
         return None
-      return RubyTestSettings().run_single_ruby_unit_command(relative_path=self.relative_file_path(), test_name=test_name, line_number=self.get_current_line_number(view))
+      if len(named) < len(tests):
+        sublime.status_message("RubyTest: skipped %d tests without a description" % (len(tests) - len(named)))
+      tests = named
+      return RubyTestSettings().run_single_ruby_unit_command(relative_path=self.relative_file_path(), test_name=unit_test_pattern(tests), line_number=line_number)
     def features(self): return super(BaseRubyTask.UnitFile, self).features() + ["run_test"]
     def get_project_root(self): return self.find_project_root()
 
   class CucumberFile(BaseFile):
     def possible_alternate_files(self): return list( set( [self.file_name.replace(".feature", ".rb"), self.file_name.replace(".feature", "_steps.rb")] ) )
     def run_all_tests_command(self): return RubyTestSettings().run_cucumber_command(relative_path=self.relative_file_path())
-    def run_single_test_command(self, view): return RubyTestSettings().run_single_cucumber_command(relative_path=self.relative_file_path(), line_number=self.get_current_line_number(view))
+    def run_single_test_command(self, view, line_ranges=None):
+      line_numbers = line_ranges and self.test_lines(view, line_ranges) or [self.get_current_line_number(view)]
+      return RubyTestSettings().format_lines("run_single_cucumber_command", line_numbers, relative_path=self.relative_file_path())
     def features(self): return ["switch_to_test", "run_test"]
     def get_project_root(self): return self.find_project_root()
 
   class RSpecFile(RubyFile):
     def possible_alternate_files(self): return list( set( [self.file_name.replace("_spec.rb", ".rb"), self.file_name.replace(".haml_spec.rb", ".haml"), self.file_name.replace(".erb_spec.rb", ".erb")] ) - set([self.file_name]) )
     def run_all_tests_command(self): return RubyTestSettings().run_rspec_command(relative_path=self.relative_file_path())
-    def run_single_test_command(self, view): return RubyTestSettings().run_single_rspec_command(relative_path=self.relative_file_path(), line_number=self.get_current_line_number(view))
+    def run_single_test_command(self, view, line_ranges=None):
+      line_numbers = line_ranges and self.test_lines(view, line_ranges) or [self.get_current_line_number(view)]
+      return RubyTestSettings().format_lines("run_single_rspec_command", line_numbers, relative_path=self.relative_file_path())
     def features(self): return super(BaseRubyTask.RSpecFile, self).features() + ["run_test"]
     def get_project_root(self): return self.find_project_root()
 
@@ -306,80 +1959,923 @@ class BaseRubyTask(sublime_plugin.TextCommand):
     def possible_alternate_files(self): return [self.file_name.replace("_steps.rb", ".feature")]
     def features(self): return ["switch_to_test"]
 
+  FILE_CLASSES = {"unit": UnitFile, "rspec": RSpecFile, "cucumber": CucumberFile, "cucumber_steps": CucumberStepsFile,
+                  "ruby": RubyFile, "erb": ErbFile, "haml": HamlFile}
+
   def find_partition_folder(self, file_name, default_partition_folder):
-    folders = self.view.window().folders()
-    file_name = file_name.replace("\\","\\\\")
-    for folder in folders:
-      folder = folder.replace("\\","\\\\")
-      if re.search(folder, file_name):
-        return re.sub(os.sep + '.+', "", file_name.replace(folder,"")[1:])
-    return default_partition_folder
+    with Profiler.phase("find_partition_folder"):
+      return self.match_partition_folder(file_name, default_partition_folder)
+
+  def match_partition_folder(self, file_name, default_partition_folder):
+    folder, parts = FolderTrie.for_folders(self.view.window().folders()).lookup(file_name)
+    return len(parts) > 1 and parts[0] or default_partition_folder
 
   def file_type(self, file_name = None, load_config = True):
     if load_config:
-      self.load_config()
+      self.load_settings()
     file_name = file_name or self.view.file_name()
     if not file_name: return BaseRubyTask.AnonymousFile()
-    if re.search('\w+\_test.rb', file_name):
-      partition_folder = self.find_partition_folder(file_name, RUBY_UNIT_FOLDER)
-      return BaseRubyTask.UnitFile(file_name, partition_folder)
-    elif re.search('test\_\w+\.rb', file_name):
-      partition_folder = self.find_partition_folder(file_name, RUBY_UNIT_FOLDER)
-      return BaseRubyTask.UnitFile(file_name, partition_folder)
-    elif re.search('\w+\_spec.rb', file_name):
-      partition_folder = self.find_partition_folder(file_name, RSPEC_UNIT_FOLDER)
-      return BaseRubyTask.RSpecFile(file_name, partition_folder)
-    elif re.search('\w+\.feature', file_name):
-      partition_folder = self.find_partition_folder(file_name, CUCUMBER_UNIT_FOLDER)
-      return BaseRubyTask.CucumberFile(file_name, partition_folder)
-    elif re.search('\w+\_steps.rb', file_name):
-      return BaseRubyTask.CucumberStepsFile(file_name)
-    elif re.search('\w+\.rb', file_name):
-      return BaseRubyTask.RubyFile(file_name)
-    elif re.search('\w+\.erb', file_name):
-      return BaseRubyTask.ErbFile(file_name)
-    elif re.search('\w+\.haml', file_name):
-      return BaseRubyTask.HamlFile(file_name)
-    else:
+    key = (file_name, tuple(self.view.window().folders()) if self.view.window() else ())
+    cached = FILE_TYPES.get(self.view.id())
+    if cached and cached[0] == key:
+      return cached[1]
+    with Profiler.phase("file_type"):
+      file = self.detect_file_type(file_name)
+    if file_name == self.view.file_name():
+      FILE_TYPES[self.view.id()] = (key, file)
+    return file
+
+  def detect_file_type(self, file_name):
+    rule = FILE_CLASSIFIER.rule(file_name)
+    if not rule:
       return BaseRubyTask.BaseFile(file_name)
+    file_class = self.FILE_CLASSES[rule["type"]]
+    partition_folders = {"unit": RUBY_UNIT_FOLDER, "rspec": RSPEC_UNIT_FOLDER, "cucumber": CUCUMBER_UNIT_FOLDER}
+    if rule["type"] not in partition_folders:
+      return file_class(file_name)
+    partition_folder = self.find_partition_folder(file_name, rule.get("folder") or partition_folders[rule["type"]])
+    return file_class(file_name, partition_folder)
 
 
 class RunSingleRubyTest(BaseRubyTask):
-  def is_enabled(self): return 'run_test' in self.file_type().features()
-  def run(self, args):
+  """Runs the tests under every selection, the tests in the visible part of
+  the file (scope "visible") or the ones touched by uncommitted changes
+  (scope "changes"), all in one process."""
+  def is_enabled(self, scope="selection"): return 'run_test' in self.file_type().features()
+  @Profiler.command
+  def run(self, args, scope="selection"):
     self.load_config()
     self.save_all()
     file = self.file_type()
-    command = file.run_single_test_command(self.view)
+    line_ranges = self.line_ranges(scope)
+    if line_ranges is None:
+      sublime.error_message("%s is not in a git repository!" % file.file_name)
+      return
+    if not line_ranges:
+      sublime.status_message("RubyTest: no changes in %s" % file.file_name)
+      return
+    command = file.run_single_test_command(self.view, line_ranges)
     self.run_shell_command(command, file.get_project_root())
 
+  def line_ranges(self, scope):
+    if scope == "changes":
+      return changed_line_ranges(self.view.file_name())
+    regions = scope == "visible" and [self.view.visible_region()] or self.view.sel()
+    ranges = []
+    for region in regions:
+      first, (last, column) = self.view.rowcol(region.begin())[0] + 1, self.view.rowcol(region.end())
+      if column == 0 and last + 1 > first:
+        last -= 1
+      ranges.append((first, last + 1))
+    return ranges
+
 
 class RunAllRubyTest(BaseRubyTask):
   def is_enabled(self): return 'run_test' in self.file_type().features()
-  def run(self, args):
+  @Profiler.command
+  def run(self, args, force=False):
     self.load_config()
     self.save_all()
     file = self.file_type(self.view.file_name())
     command = file.run_all_tests_command()
-    if self.run_shell_command(command, file.get_project_root()):
+    project_root = file.get_project_root()
+    relative_path = file.relative_file_path()
+    failures = command and FailedExamples.for_project(project_root).in_file(relative_path)
+    cache = command and self.result_cache(project_root)
+    if not cache:
+      return self.run_file(command, project_root, relative_path, failures)
+    environment = RubyEnvironment.for_project(project_root)
+    def check():
+      keys = cache.keys([relative_path], lambda relative_path: command, environment.ruby_version())
+      sublime.set_timeout(lambda: self.run_file(command, project_root, relative_path, failures, keys, force), 0)
+    sublime.status_message("RubyTest: checking whether %s changed" % relative_path)
+    threading.Thread(target=check).start()
+
+  def run_file(self, command, project_root, relative_path, failures, keys=None, force=False):
+    on_success = None
+    if keys:
+      passed_at = not force and not failures and RunResultCache.for_project(project_root).passed(keys[relative_path])
+      if passed_at:
+        return self.report_cached(project_root, relative_path, passed_at)
+      on_success = lambda: self.record_passes(project_root, keys)
+    if failures and self.failures_first():
+      run_file = lambda: self.run_shell_command(command, project_root, on_success, erase=False, files=[relative_path])
+      self.run_jobs(self.failure_jobs(failures, project_root), project_root, on_success=run_file)
+    elif self.run_shell_command(command, project_root, on_success, files=[relative_path]):
       pass
     else:
       sublime.error_message("Only *_test.rb, test_*.rb, *_spec.rb, *.feature files supported!")
 
+  def report_cached(self, project_root, relative_path, passed_at):
+    message = "[cached] %s passed %s and has not changed since; run RubyTest: Run All Ruby Tests (ignore cache) to run it anyway\n" % (
+      relative_path, time.strftime("%Y-%m-%d %H:%M", time.localtime(passed_at)))
+    self.display_results(project_root).panel.run_command("append_ruby_test_output", {"characters": message, "erase": True})
+    sublime.status_message("RubyTest: %s unchanged since it passed" % relative_path)
+
 
 class RunLastRubyTest(BaseRubyTask):
   def load_last_run(self):
     self.load_config()
     self.save_all()
     s = sublime.load_settings("RubyTest.last-run")
-    return (s.get("last_test_run"), s.get("last_test_working_dir"))
+    last_command = s.get("last_test_run")
+    # runs saved before the after callback became a separate stage include it
+    if AFTER_CALLBACK and last_command and last_command.endswith(" ; " + AFTER_CALLBACK):
+      last_command = last_command[:-len(" ; " + AFTER_CALLBACK)]
+    return (last_command, s.get("last_test_working_dir"))
 
+  @Profiler.command
   def run(self, args):
     last_command, working_dir = self.load_last_run()
     self.run_shell_command(last_command, working_dir)
 
+class RunFailedRubyTests(BaseRubyTask):
+  def is_enabled(self): return bool(self.window().folders())
+  @Profiler.command
+  def run(self, args):
+    self.load_config()
+    self.save_all()
+    project_root = self.suite_root()
+    failures = FailedExamples.for_project(project_root).failures
+    if not failures:
+      sublime.status_message("RubyTest: no failed tests to run")
+      return
+    self.run_jobs(self.failure_jobs(failures, project_root), project_root, command="[parallel failures]")
+
+
+class ProjectStore(object):
+  """Base of the stores kept per project: for_project returns the one
+  instance of the class for a project root."""
+  instances = {}
+
+  @classmethod
+  def for_project(cls, project_root):
+    key = (cls, project_root)
+    if key not in ProjectStore.instances:
+      ProjectStore.instances[key] = cls(project_root)
+    return ProjectStore.instances[key]
+
+
+class FailedExamples(ProjectStore):
+  """Examples that failed the last time their spec / test / feature file ran."""
+  def __init__(self, project_root):
+    self.path = storage_path("failures-%s.json" % project_key(project_root))
+    self.failures = read_json(self.path, [])
+    self.lock = threading.Lock()
+
+  def in_file(self, relative_path):
+    return [failure for failure in self.failures if failure["file"] == relative_path]
+
+  def update(self, results):
+    """Replaces the failures of every file the run reported examples for."""
+    reported = set(example.get("file") for example in results.examples)
+    failed = [dict((key, example.get(key)) for key in ["file", "line", "name", "description"])
+              for example in results.failures() if example.get("file")]
+    if not reported:
+      return
+    with self.lock:
+      # entries filed under code files by older formatters would never clear
+      self.failures = [failure for failure in self.failures if failure["file"] not in reported and test_framework(failure["file"])] + failed
+      write_json(self.path, self.failures)
+
+
+class TestTimings(ProjectStore):
+  """Wall time of every spec / test / feature file of a project, smoothed over runs."""
+  SMOOTHING = 0.5
+
+  def __init__(self, project_root):
+    self.path = storage_path("timings-%s.json" % project_key(project_root))
+    self.timings = read_json(self.path, {})
+    self.lock = threading.Lock()
+
+  def estimate(self, relative_path):
+    return self.timings.get(relative_path)
+
+  def record(self, files, seconds, results):
+    """Records the time of each of files, run together in seconds: the summed
+    durations of its examples when the formatters reported them, else its
+    share of what is left of seconds, in proportion to previous timings."""
+    measured = results.file_durations(files)
+    unmeasured = [f for f in files if f not in measured]
+    with self.lock:
+      if unmeasured:
+        rest = max(0.0, seconds - sum(measured.values()))
+        known = [self.timings[f] for f in unmeasured if f in self.timings]
+        default = known and sum(known) / len(known) or 1.0
+        weights = [self.timings.get(f, default) for f in unmeasured]
+        total = sum(weights) or 1.0
+        for relative_path, weight in zip(unmeasured, weights):
+          measured[relative_path] = rest * weight / total
+      for relative_path, seconds in measured.items():
+        previous = self.timings.get(relative_path, seconds)
+        self.timings[relative_path] = round(previous + (seconds - previous) * self.SMOOTHING, 3)
+
+  def save(self):
+    with self.lock:
+      timings = dict(self.timings)
+    write_json(self.path, timings)
+
+
+class TestReferences(ProjectStore):
+  """The files every ruby spec / test requires and the constants it mentions.
+
+  Parsed once per file and kept, with the file's mtime, in
+  references-<project>.json; refresh() only re-reads files that changed.
+  """
+  REQUIRE = re.compile(r"""^\s*(require|require_relative|load)\b\s*\(?\s*["']([^"']+)["']""", re.M)
+  CONSTANT = re.compile(r"(?<![\w:])[A-Z]\w*(?:::[A-Z]\w*)*")
+  DEFINITION = re.compile(r"^\s*(?:class|module)\s+(?:::)?([A-Z]\w*(?:::[A-Z]\w*)*)", re.M)
+  VERSION = 1
+
+  def __init__(self, project_root):
+    self.project_root = project_root
+    self.path = storage_path("references-%s.json" % project_key(project_root))
+    data = read_json(self.path, {})
+    self.files = data.get("version") == self.VERSION and data.get("files") or {}
+    self.by_require = {}
+    self.by_constant = {}
+    self.lock = threading.Lock()
+
+  def refresh(self, test_files):
+    with self.lock:
+      files = {}
+      for relative_path in test_files:
+        modified = mtime(os.path.join(self.project_root, relative_path))
+        entry = self.files.get(relative_path)
+        files[relative_path] = entry and entry[0] == modified and entry or [modified] + self.parse(relative_path)
+      changed = files != self.files
+      self.files = files
+      self.by_require = {}
+      self.by_constant = {}
+      for relative_path, (_, requires, constants) in files.items():
+        for name in requires:
+          self.by_require.setdefault(name, set()).add(relative_path)
+        for name in constants:
+          self.by_constant.setdefault(name, set()).add(relative_path)
+    if changed:
+      write_json(self.path, {"version": self.VERSION, "files": files})
+
+  def parse(self, relative_path):
+    text = read_text(os.path.join(self.project_root, relative_path))
+    requires = set()
+    for method, name in self.REQUIRE.findall(text):
+      name = re.sub(r"\.rb$", "", name)
+      if method == "require_relative":
+        name = os.path.normpath(os.path.join(os.path.dirname(relative_path), name)).replace(os.sep, "/")
+      requires.add(name)
+    constants = set()
+    for name in self.CONSTANT.findall(text):
+      constants.update([name, name.split("::")[-1]])
+    return [sorted(requires), sorted(constants)]
+
+  def tests_depending_on(self, relative_path):
+    """Tests requiring relative_path (by any trailing part of its path) or
+    mentioning a constant it defines, or that its file name implies."""
+    name, extension = os.path.splitext(relative_path.replace(os.sep, "/"))
+    if extension != ".rb":
+      return set()
+    parts = name.split("/")
+    constants = set([camelize(parts[-1])])
+    for constant in self.DEFINITION.findall(read_text(os.path.join(self.project_root, relative_path))):
+      constants.update([constant, constant.split("::")[-1]])
+    tests = set()
+    with self.lock:
+      for i in range(len(parts)):
+        tests.update(self.by_require.get("/".join(parts[i:]), ()))
+      for constant in constants:
+        tests.update(self.by_constant.get(constant, ()))
+    return tests
+
+
+class TestCoverage(ProjectStore):
+  """Project files executed by each spec / test file, as reported by
+  support/rubytest_coverage.rb when "collect_coverage" is enabled.
+
+  The ruby side appends one JSON line per run to coverage-<project>.log;
+  those are folded into coverage-<project>.json the next time it is read.
+  """
+  def __init__(self, project_root):
+    key = project_key(project_root)
+    self.path = storage_path("coverage-%s.json" % key)
+    self.log_path = storage_path("coverage-%s.log" % key)
+    self.coverage = read_json(self.path, {})
+    self.lock = threading.Lock()
+
+  def collecting(self, env):
+    """env for a run that reports what it executed."""
+    rubyopt = " ".join(["-rrubytest_coverage"] + [option for option in [env.get("RUBYOPT", os.environ.get("RUBYOPT"))] if option])
+    return dict(env, RUBYOPT=rubyopt, RUBYTEST_COVERAGE=self.log_path)
+
+  def tests_covering(self, sources):
+    self.merge_log()
+    sources = set(source.replace(os.sep, "/") for source in sources)
+    with self.lock:
+      return set(os.path.normpath(test) for test, covered in self.coverage.items() if sources.intersection(covered))
+
+  def sources_of(self, test):
+    self.merge_log()
+    with self.lock:
+      return list(self.coverage.get(test.replace(os.sep, "/"), ()))
+
+  def merge_log(self):
+    merging = self.log_path + ".merging"
+    with self.lock:
+      try:
+        os.rename(self.log_path, merging)
+      except OSError:
+        return
+      for line in read_text(merging).splitlines():
+        try:
+          run = json.loads(line)
+        except ValueError:
+          continue
+        for test in run["tests"]:
+          self.coverage[test] = run["sources"]
+      os.remove(merging)
+      write_json(self.path, self.coverage)
+
+
+class RunResultCache(ProjectStore):
+  """Test files that passed, keyed by a digest of everything their result
+  depends on: the command, the ruby version, the file itself, the code files
+  it maps to (its counterparts and, with collect_coverage, the files it
+  executed) and the files every test loads: the Gemfile, helpers, config and
+  support / factory / fixture directories.
+
+  Keys read every file involved, so they are computed off the UI thread.
+  Kept in results-<project>.json; beyond CAPACITY entries the least recently
+  used are dropped.
+  """
+  VERSION = 2
+  CAPACITY = 5000
+  SHARED_DIRECTORIES = ["config", "spec/support", "spec/factories", "spec/fixtures", "test/support", "test/factories", "test/fixtures", "features/support"]
+
+  def __init__(self, project_root):
+    self.project_root = project_root
+    self.path = storage_path("results-%s.json" % project_key(project_root))
+    data = read_json(self.path, {})
+    self.entries = data.get("version") == self.VERSION and data.get("entries") or {}
+    self.lock = threading.Lock()
+
+  def key(self, relative_path, command, shared):
+    parts = [command, shared]
+    for path in [relative_path] + sorted(self.sources(relative_path)):
+      parts += [path.replace(os.sep, "/"), file_digest(os.path.join(self.project_root, path))]
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+  def index(self):
+    """The file index covering the project: the window folder's one when the
+    project is nested in it, rather than a second index of the subtree."""
+    indexes = ProjectFileIndex.containing(os.path.join(self.project_root, "Gemfile"))
+    if indexes:
+      return max(indexes, key=lambda index: len(index.root))
+    return ProjectFileIndex.for_folder(self.project_root, IGNORED_DIRECTORIES)
+
+  def sources(self, relative_path):
+    sources = set(os.path.relpath(path, self.project_root) for path in self.index().alternates_of(os.path.join(self.project_root, relative_path)))
+    sources.update(os.path.normpath(path) for path in TestCoverage.for_project(self.project_root).sources_of(relative_path))
+    sources.discard(relative_path)
+    return sources
+
+  def shared(self, ruby_version):
+    """Digest of the ruby version and the files all tests depend on."""
+    index = self.index()
+    paths = [os.path.join(self.project_root, name) for name in WarmRunner.WATCHED_FILES]
+    for directory in self.SHARED_DIRECTORIES:
+      paths.extend(index.files_under(os.path.join(self.project_root, directory)))
+    parts = [ruby_version] + [(os.path.relpath(path, self.project_root).replace(os.sep, "/"), file_digest(path)) for path in sorted(set(paths))]
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+  def keys(self, files, command_for, ruby_version):
+    """{relative_path: key} of the files, with command_for(relative_path)
+    the command that runs one of them alone. Reads every file involved: call
+    it from a worker thread."""
+    shared = self.shared(ruby_version)
+    return dict((relative_path, self.key(relative_path, command_for(relative_path), shared)) for relative_path in files)
+
+  def passed(self, key):
+    """When the file last passed with this key, or None."""
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry:
+        entry["used"] = time.time()
+      return entry and entry["passed_at"]
+
+  def record(self, keys):
+    """Remembers that the files of {relative_path: key} passed."""
+    now = time.time()
+    with self.lock:
+      for relative_path, key in keys.items():
+        self.entries[key] = {"file": relative_path.replace(os.sep, "/"), "passed_at": now, "used": now}
+      if len(self.entries) > self.CAPACITY:
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"])[:len(self.entries) - self.CAPACITY]:
+          del self.entries[key]
+
+  def save(self):
+    with self.lock:
+      data = {"version": self.VERSION, "entries": dict(self.entries)}
+    write_json(self.path, data)
+
+
+class RunHistory(ProjectStore):
+  """Append-only log of a project's test runs, one JSON line per run in
+  history-<project>.jsonl: when it ran, the command, project root, wall
+  time, exit code and a [name, status, seconds] triple per example.
+
+  Past MAX_BYTES the oldest half of the runs is dropped.
+  """
+  MAX_BYTES = 16 * 1024 * 1024
+  WINDOW = 10        # runs making up an example's rolling median
+  MIN_SAMPLES = 3    # earlier runs needed before a regression is reported
+  SLOWDOWN = 1.5     # latest / median ratio counted as a regression
+  MIN_SLOWDOWN = 0.05
+  STATUSES = {"passed": "p", "failed": "f", "pending": "s"}
+
+  def __init__(self, project_root):
+    self.project_root = project_root
+    self.path = storage_path("history-%s.jsonl" % project_key(project_root))
+    self.lock = threading.Lock()
+
+  @classmethod
+  def example_name(cls, example):
+    name = example.get("description") or example.get("name")
+    if name:
+      return "%s %s" % (example.get("file"), name)
+    return "%s:%s" % (example.get("file"), example.get("line"))
+
+  def record(self, command, elapsed, returncode, results):
+    """Appends a run of command, as the user configured it (before the plugin
+    adds formatters, shims or the warm runner client)."""
+    with results.lock:
+      examples = [[self.example_name(example), self.STATUSES.get(example.get("status"), "?"), round(example.get("duration") or 0, 4)]
+                  for example in results.examples if example.get("file")]
+    run = {"at": int(time.time()), "command": command, "root": self.project_root, "duration": round(elapsed, 3), "exit": returncode, "examples": examples}
+    line = json.dumps(run, separators=(",", ":")) + "\n"
+    with self.lock:
+      try:
+        with codecs.open(self.path, "a", "utf-8") as f:
+          f.write(line)
+        if os.path.getsize(self.path) > self.MAX_BYTES:
+          self.compact()
+      except (IOError, OSError):
+        pass
+
+  def compact(self):
+    lines = read_text(self.path).splitlines(True)
+    temp_file = self.path + ".tmp"
+    with codecs.open(temp_file, "w", "utf-8") as f:
+      f.writelines(lines[len(lines) // 2:])
+    if os.name == "nt":
+      os.remove(self.path)
+    os.rename(temp_file, self.path)
+
+  def runs(self):
+    with self.lock:
+      text = read_text(self.path)
+    runs = []
+    for line in text.splitlines():
+      try:
+        runs.append(json.loads(line))
+      except ValueError:
+        continue
+    return runs
+
+  def report(self, limit=20):
+    runs = self.runs()
+    if not runs:
+      return "RubyTest history: no test runs recorded for %s yet\n" % self.project_root
+    durations = {}
+    outcomes = {}
+    for run in runs:
+      for name, status, seconds in run["examples"]:
+        if status == "p" or status == "f":
+          durations.setdefault(name, []).append(seconds)
+          outcomes.setdefault(name, []).append(status)
+    lines = ["RubyTest history: %d runs of %s since %s" % (len(runs), self.project_root, time.strftime("%Y-%m-%d %H:%M", time.localtime(runs[0]["at"])))]
+
+    lines += ["", "Slowest examples (median of the last %d runs):" % self.WINDOW]
+    medians = dict((name, median(values[-self.WINDOW:])) for name, values in durations.items())
+    for name in sorted(medians, key=medians.get, reverse=True)[:limit]:
+      lines.append("  %9s  %s" % (duration(medians[name]), name))
+
+    lines += ["", "Slower than their median of the %d runs before:" % self.WINDOW]
+    regressions = []
+    for label, samples in [("%s", durations), ("[run] %s", self.command_durations(runs))]:
+      for name, values in samples.items():
+        before = self.regressed(values)
+        if before is not None:
+          regressions.append((values[-1] - before, label % name, before, values[-1]))
+    for _, name, before, latest in sorted(regressions, reverse=True)[:limit]:
+      lines.append("  %9s -> %9s  %s" % (duration(before), duration(latest), name))
+    if not regressions:
+      lines.append("  none")
+
+    lines += ["", "Flipping between pass and fail (last %d runs):" % (self.WINDOW * 2)]
+    flaky = []
+    for name, statuses in outcomes.items():
+      recent = statuses[-self.WINDOW * 2:]
+      flips = sum(1 for a, b in zip(recent, recent[1:]) if a != b)
+      if flips:
+        flaky.append((flips, recent.count("f"), len(recent), name))
+    for flips, failed, count, name in sorted(flaky, reverse=True)[:limit]:
+      lines.append("  %2d flips, failed %d of %d  %s" % (flips, failed, count, name))
+    if not flaky:
+      lines.append("  none")
+    return "\n".join(lines) + "\n"
+
+  def regressed(self, values):
+    """The rolling median before the latest value when that one is a regression."""
+    earlier = values[-self.WINDOW - 1:-1]
+    if len(earlier) >= self.MIN_SAMPLES:
+      before = median(earlier)
+      if values[-1] > before * self.SLOWDOWN and values[-1] - before > self.MIN_SLOWDOWN:
+        return before
+
+  def command_durations(self, runs):
+    """Wall times of the successful runs of each command."""
+    durations = {}
+    for run in runs:
+      if run["exit"] == 0:
+        durations.setdefault(run["command"], []).append(run["duration"])
+    return durations
+
+
+class ParallelSuiteRun(object):
+  """Runs suite jobs on a pool of worker slots and merges their output.
+
+  Plain output lines are prefixed with their worker number; each worker gets
+  its own TEST_ENV_NUMBER (parallel_tests convention) so it can use its own
+  database.
+  """
+  def __init__(self, window, jobs, workers, working_dir, results_view, on_success=None, erase=True, cached=(), command=None):
+    self.window = window
+    self.jobs = list(jobs)
+    self.cached = list(cached)
+    self.command = command
+    self.on_success = on_success
+    self.timings = TestTimings.for_project(working_dir)
+    self.workers = max(1, min(workers, len(self.jobs)))
+    self.working_dir = working_dir
+    self.failed = []
+    self.passed_keys = False
+    self.running = 0
+    self.processes = {}
+    self.killed = self.done = False
+    self.lock = threading.Lock()
+    self.started_at = time.time()
+    self.results = TestResults()
+    self.profile = Profiler.current
+    self.results_view = results_view
+    self.erase = erase
+
+  def start(self):
+    RunRegistry.register(self.working_dir, self)
+    self.results_view.settings().set("result_file_regex", RESULT_FILE_REGEX)
+    self.results_view.settings().set("result_base_dir", self.working_dir)
+    self.results_view.run_command("append_ruby_test_output", {"characters": "", "erase": self.erase})
+    self.panel = OutputPanel(self.results_view, self.erase)
+    self.renderer = ResultRenderer(self.panel)
+    if self.cached:
+      self.panel.write("Skipping %d files that passed before and have not changed since\n" % len(self.cached))
+    self.panel.write("Running %d jobs on %d workers\n\n" % (len(self.jobs), self.workers))
+    for worker in range(1, self.workers + 1):
+      self.run_next(worker)
+
+  def run_next(self, worker):
+    with self.lock:
+      job = self.jobs and self.jobs.pop(0)
+      if job:
+        self.running += 1
+      # finish() writes the report and the stores, so not while holding the lock
+      finished = not job and self.running == 0 and not self.done
+      if finished:
+        self.done = True
+    if not job:
+      return finished and self.finish()
+    cmd, shell, env = job["command_line"]
+    env = dict(env, TEST_ENV_NUMBER=worker > 1 and str(worker) or "", PARALLEL_TEST_GROUPS=str(self.workers), RUBYTEST_WORKER=str(worker))
+    job["parser"] = ResultParser(self.results, self.renderer, "[%d] " % worker, partial_lines=False)
+    job["started_at"] = time.time()
+    try:
+      process = TestProcess(cmd, shell, env, self.working_dir, job["parser"].feed, functools.partial(self.job_finished, worker, job))
+    except OSError as e:
+      job["parser"].feed("%s\n" % e)
+      return self.job_finished(worker, job, 127)
+    with self.lock:
+      self.processes[worker] = process
+      killed = self.killed
+    if killed:
+      process.kill()
+
+  def kill(self):
+    """Stops the running jobs and drops the queued ones."""
+    with self.lock:
+      self.killed = True
+      self.jobs = []
+      processes = list(self.processes.values())
+    for process in processes:
+      process.kill()
+
+  def job_finished(self, worker, job, returncode):
+    job["parser"].close()
+    if job.get("timed", True) and not self.killed:
+      self.timings.record(job["files"], time.time() - job["started_at"], self.results)
+    if returncode == 0 and job.get("cache_keys") and not self.killed:
+      RunResultCache.for_project(self.working_dir).record(job["cache_keys"])
+      self.passed_keys = True
+    with self.lock:
+      self.running -= 1
+      if returncode != 0:
+        self.failed.append(job)
+    self.run_next(worker)
+
+  def finish(self):
+    self.done = True
+    RunRegistry.finished(self.working_dir, self)
+    if self.profile is not None:
+      Profiler.add(self.profile, "test_run", time.time() - self.started_at)
+    if self.killed:
+      return self.renderer.finish(self.results, time.time() - self.started_at, 1, killed=True)
+    self.timings.save()
+    if self.passed_keys:
+      RunResultCache.for_project(self.working_dir).save()
+    if self.failed and not self.results.failures():
+      self.renderer.raw("\nFailed jobs:\n" + "".join("  %s\n" % " ".join(job["files"]) for job in self.failed))
+    self.renderer.finish(self.results, time.time() - self.started_at, self.failed and 1 or 0)
+    FailedExamples.for_project(self.working_dir).update(self.results)
+    if RECORD_HISTORY and self.command:
+      RunHistory.for_project(self.working_dir).record(self.command, time.time() - self.started_at, self.failed and 1 or 0, self.results)
+    if not self.failed and self.on_success:
+      sublime.set_timeout(self.on_success, 0)
+    sublime.set_timeout(lambda: sublime.status_message("RubyTest: suite " + (self.failed and "failed" or "passed")), 0)
+
+
+class RunRubyTestSuite(BaseRubyTask):
+  """Runs every spec / test / feature of the project on parallel workers."""
+  FRAMEWORKS = ["rspec", "unit", "cucumber"]
+  COMMANDS = {"rspec": "run_rspec_command", "unit": "run_ruby_unit_command", "cucumber": "run_cucumber_command"}
+
+  def is_enabled(self): return bool(self.window().folders())
+
+  @Profiler.command
+  def run(self, args, force=False):
+    self.load_config()
+    self.save_all()
+    project_root = self.suite_root()
+    workers = sublime.load_settings("RubyTest.sublime-settings").get("parallel_workers") or cpu_count()
+    cache = self.result_cache(project_root)
+    if not cache:
+      return self.run_suite(project_root, workers, self.suite_files(project_root))
+    commands = self.single_file_commands()
+    environment = RubyEnvironment.for_project(project_root)
+    def check():
+      suite = self.suite_files(project_root)
+      ruby_version = environment.ruby_version()
+      keys = dict((framework, cache.keys(files, lambda relative_path: commands[framework](relative_path=relative_path), ruby_version))
+                  for framework, files in suite)
+      sublime.set_timeout(lambda: self.run_suite(project_root, workers, suite, keys, force), 0)
+    sublime.status_message("RubyTest: checking which test files changed")
+    threading.Thread(target=check).start()
+
+  def run_suite(self, project_root, workers, suite, keys=None, force=False):
+    cached = []
+    jobs = self.suite_jobs(project_root, workers, suite, keys, force, cached)
+    if not jobs and not cached:
+      sublime.error_message("No specs, tests or features found under %s" % project_root)
+      return
+    failures = FailedExamples.for_project(project_root).failures
+    if failures and self.failures_first():
+      command = self.history_command("suite", suite)
+      run_suite = lambda: ParallelSuiteRun(self.window(), jobs, workers, project_root, self.display_results(project_root).panel, erase=False, cached=cached, command=command).start()
+      self.run_jobs(self.failure_jobs(failures, project_root), project_root, on_success=run_suite)
+    else:
+      ParallelSuiteRun(self.window(), jobs, workers, project_root, self.display_results(project_root).panel, cached=cached,
+                       command=self.history_command("suite", suite)).start()
+
+  def suite_files(self, project_root):
+    folders = {"rspec": RSPEC_UNIT_FOLDER, "unit": RUBY_UNIT_FOLDER, "cucumber": CUCUMBER_UNIT_FOLDER}
+    index = ProjectFileIndex.for_folder(project_root, IGNORED_DIRECTORIES)
+    suite = []
+    for framework in self.FRAMEWORKS:
+      files = [os.path.relpath(path, project_root) for path in index.files_under(os.path.join(project_root, folders[framework]))
+               if test_framework(path) == framework]
+      suite.append((framework, sorted(files)))
+    return suite
+
+  def single_file_commands(self):
+    settings = RubyTestSettings()
+    return dict((framework, getattr(settings, name)) for framework, name in self.COMMANDS.items())
+
+  def history_command(self, kind, suite):
+    """What RunHistory records a parallel run as: the kind of run and the
+    configured command of each framework it runs, whatever the file count."""
+    settings = RubyTestSettings()
+    return "[parallel %s] %s" % (kind, "; ".join("%s: %s" % (framework, settings.template(self.COMMANDS[framework])) for framework, files in suite if files))
+
+  def suite_jobs(self, project_root, workers, suite=None, keys=None, force=False, cached=None):
+    """Jobs ordered longest first: files with a known duration are balanced
+    into one shard per worker, the rest go to a queue of small batches that
+    idle workers pick up.
+
+    With RunResultCache keys ({framework: {relative_path: key}}), files that
+    passed with the same key and have no recorded failures are left out (and
+    appended to cached) unless force is set; the keys of the others ride
+    along with their job."""
+    settings = RubyTestSettings()
+    commands = self.single_file_commands()
+    cache = keys is not None and RunResultCache.for_project(project_root)
+    batch_commands = dict(commands, unit=settings.unit_batch_command())
+    timings = TestTimings.for_project(project_root)
+    failed = set(failure["file"] for failure in FailedExamples.for_project(project_root).failures)
+    jobs = []
+    for framework, files in suite or self.suite_files(project_root):
+      file_keys = cache and keys.get(framework) or {}
+      if file_keys and not force:
+        unchanged = set(f for f in files if f not in failed and cache.passed(file_keys[f]))
+        if cached is not None:
+          cached.extend(f for f in files if f in unchanged)
+        files = [f for f in files if f not in unchanged]
+      # ruby -Itest only runs its first file argument: test files are batched
+      # through support/load_tests.rb, or run one per job for other commands
+      batch_command = batch_commands[framework]
+      batch_size = 1 if batch_command is None else max(1, len(files) // (workers * 4))
+      for expected, shard in self.shards(files, workers, batch_size, timings):
+        command = (batch_command or commands[framework])(relative_path=" ".join(shard))
+        job = {"files": shard, "expected": expected, "command_line": self.command_line(command, project_root)}
+        if file_keys:
+          job["cache_keys"] = dict((f, file_keys[f]) for f in shard)
+        jobs.append(job)
+    jobs.sort(key=lambda job: job["expected"] is None and -1 or job["expected"], reverse=True)
+    return jobs
+
+  def shards(self, files, workers, batch_size, timings):
+    known = sorted([f for f in files if timings.estimate(f) is not None], key=timings.estimate, reverse=True)
+    unknown = [f for f in files if timings.estimate(f) is None]
+    if batch_size == 1:
+      return [(timings.estimate(f), [f]) for f in known] + [(None, [f]) for f in unknown]
+    balanced = [[0.0, []] for _ in range(workers)]
+    for relative_path in known:
+      shard = min(balanced, key=lambda shard: shard[0])
+      shard[0] += timings.estimate(relative_path)
+      shard[1].append(relative_path)
+    return [(total, shard) for total, shard in balanced if shard] + \
+      [(None, unknown[i:i + batch_size]) for i in range(0, len(unknown), batch_size)]
+
+
+class RunAffectedRubyTests(RunRubyTestSuite):
+  """Runs the specs, tests and features affected by the uncommitted changes
+  of the project: changed test files, the counterparts of changed code
+  files, tests requiring or mentioning what changed and, with
+  collect_coverage, tests that executed a changed file."""
+  @Profiler.command
+  def run(self, args):
+    self.load_config()
+    self.save_all()
+    project_root = self.suite_root()
+    changed = changed_files(project_root)
+    if changed is None:
+      sublime.error_message("%s is not in a git repository!" % project_root)
+    elif not changed:
+      sublime.status_message("RubyTest: no changes in %s" % project_root)
+    else:
+      sublime.status_message("RubyTest: finding tests affected by %d changed files" % len(changed))
+      threading.Thread(target=self.find_affected, args=(project_root, changed)).start()
+
+  def find_affected(self, project_root, changed):
+    suite = self.affected_suite(project_root, changed)
+    sublime.set_timeout(lambda: self.run_affected(project_root, suite), 0)
+
+  def run_affected(self, project_root, suite):
+    count = sum(len(files) for _, files in suite)
+    if not count:
+      sublime.status_message("RubyTest: no tests affected by the changes in %s" % project_root)
+      return
+    sublime.status_message("RubyTest: running %d affected test files" % count)
+    workers = sublime.load_settings("RubyTest.sublime-settings").get("parallel_workers") or cpu_count()
+    run = ParallelSuiteRun(self.window(), self.suite_jobs(project_root, workers, suite), workers, project_root, self.display_results(project_root).panel,
+                           command=self.history_command("affected", suite))
+    run.start()
+    return run
+
+  def affected_suite(self, project_root, changed):
+    suite = self.suite_files(project_root)
+    test_files = set(f for _, files in suite for f in files)
+    index = ProjectFileIndex.for_folder(project_root, IGNORED_DIRECTORIES)
+    references = TestReferences.for_project(project_root)
+    references.refresh([f for f in test_files if f.endswith(".rb")])
+    affected = set(COLLECT_COVERAGE and TestCoverage.for_project(project_root).tests_covering(changed) or [])
+    for relative_path in changed:
+      affected.add(relative_path)
+      affected.update(self.counterparts(index, os.path.join(project_root, relative_path), project_root))
+      affected.update(references.tests_depending_on(relative_path))
+    return [(framework, [f for f in files if f in affected]) for framework, files in suite]
+
+  def counterparts(self, index, path, project_root):
+    """The closest spec / test / feature of each framework for a code file."""
+    best = {}
+    for alternate in index.alternates_of(path):
+      framework = test_framework(alternate)
+      similarity = path_similarity(path, alternate)
+      if framework and best.setdefault(framework, similarity) == similarity:
+        yield os.path.relpath(alternate, project_root)
+
+
+class TestWatcher(object):
+  """Watch mode for one project: re-runs the tests affected by saved files.
+
+  Saves are collected until none arrived for DEBOUNCE milliseconds, so a
+  save_all starts a single run. A save while tests are running cancels that
+  run; its files are run again together with the new ones. Runs the watcher
+  didn't start (like one whose save_on_run triggered the saves) are left to
+  finish first.
+  """
+  DEBOUNCE = 300
+  watchers = {}
+
+  @classmethod
+  def toggle(cls, project_root, window):
+    watcher = cls.watchers.pop(project_root, None)
+    if watcher:
+      watcher.cancel()
+    else:
+      cls.watchers[project_root] = cls(project_root, window)
+    return not watcher
+
+  @classmethod
+  def containing(cls, path):
+    return [watcher for root, watcher in list(cls.watchers.items()) if path.startswith(root + os.sep)]
+
+  def __init__(self, project_root, window):
+    self.project_root = project_root
+    self.window = window
+    self.saved = set()
+    self.resolving = set()
+    self.generation = 0
+    self.run = None
+    self.run_files = set()
+
+  def active(self):
+    return TestWatcher.watchers.get(self.project_root) is self
+
+  def file_saved(self, path):
+    self.saved.add(os.path.relpath(path, self.project_root))
+    self.generation += 1
+    generation = self.generation
+    self.cancel()
+    sublime.set_timeout(lambda: self.fire(generation), self.DEBOUNCE)
+
+  def fire(self, generation):
+    if generation != self.generation or not self.active():
+      return
+    changed = self.saved | self.resolving
+    self.saved = set()
+    self.resolving = changed
+    command = RunAffectedRubyTests(self.window.active_view())
+    command.load_config()
+    threading.Thread(target=self.resolve, args=(command, generation, changed)).start()
+
+  def resolve(self, command, generation, changed):
+    suite = command.affected_suite(self.project_root, sorted(changed))
+    sublime.set_timeout(lambda: self.start(command, generation, changed, suite), 0)
+
+  def start(self, command, generation, changed, suite):
+    # a newer save is pending: its run will include these files
+    if generation != self.generation or not self.active():
+      return
+    current = RunRegistry.runs.get(self.project_root)
+    if current is not None and current is not self.run:
+      sublime.set_timeout(lambda: self.start(command, generation, changed, suite), self.DEBOUNCE)
+      return
+    self.resolving = set()
+    if self.run:
+      self.run.panel.close()
+    self.run_files = changed
+    self.run = command.run_affected(self.project_root, suite)
+
+  def cancel(self):
+    if self.run and not self.run.done:
+      self.run.kill()
+      self.saved.update(self.run_files)
+
+
+class ToggleRubyTestWatch(BaseRubyTask):
+  def is_enabled(self): return bool(self.window().folders())
+  def run(self, args):
+    self.load_config()
+    project_root = self.suite_root()
+    watching = TestWatcher.toggle(project_root, self.window())
+    sublime.status_message("RubyTest: %s watching %s" % (watching and "started" or "stopped", project_root))
+
+
+class TestWatcherListener(sublime_plugin.EventListener):
+  def on_post_save(self, view):
+    for watcher in TestWatcher.containing(view.file_name() or ""):
+      watcher.file_saved(view.file_name())
+
+
 class VerifyRubyFile(BaseRubyTask):
   def is_enabled(self): return 'verify_syntax' in self.file_type().features()
+  @Profiler.command
   def run(self, args):
     self.load_config()
     file = self.file_type()
@@ -391,21 +2887,16 @@ class VerifyRubyFile(BaseRubyTask):
 
 class SwitchBetweenCodeAndTest(BaseRubyTask):
   def is_enabled(self): return 'switch_to_test' in self.file_type().features()
+  @Profiler.command
   def run(self, args, split_view):
     self.load_config()
-    possible_alternates = self.file_type().possible_alternate_files()
-    alternates = self.project_files(lambda file: file in possible_alternates)
-
-    for alternate in alternates:
-      if re.search(self.file_type().parent_dir_name(), alternate):
-        alternates = [alternate]
-        break
+    alternates = self.alternate_files(self.view.file_name())
 
     if alternates:
       if split_view:
         ShowPanels(self.window()).split()
-      if len(alternates) == 1:
-        self.window().open_file(alternates.pop())
+      if len(alternates) == 1 or self.is_best_match(alternates):
+        self.window().open_file(alternates[0])
       else:
         callback = functools.partial(self.on_selected, alternates)
         self.window().show_quick_panel(alternates, callback)
@@ -418,14 +2909,52 @@ class SwitchBetweenCodeAndTest(BaseRubyTask):
 
     self.window().open_file(alternates[index])
 
-  def walk(self, directory):
-    for dir, dirnames, files in os.walk(directory):
-      dirnames[:] = [dirname for dirname in dirnames if dirname not in IGNORED_DIRECTORIES]
-      yield dir, dirnames, files
+  def is_best_match(self, alternates):
+    file_name = self.view.file_name()
+    return path_similarity(file_name, alternates[0]) > path_similarity(file_name, alternates[1])
+
+  def alternate_files(self, file_name):
+    with Profiler.phase("alternates"):
+      return self.find_alternate_files(file_name)
+
+  def find_alternate_files(self, file_name):
+    indexes = ProjectFileIndex.for_window(self.window(), IGNORED_DIRECTORIES)
+    alternates = [path for index in indexes for path in index.alternates_of(file_name)]
+    return sorted(alternates, key=lambda alternate: path_similarity(file_name, alternate), reverse=True)
+
+
+class FileTypeCacheListener(sublime_plugin.EventListener):
+  def on_close(self, view):
+    FILE_TYPES.pop(view.id(), None)
 
-  def project_files(self, file_matcher):
-    directories = self.window().folders()
-    return [os.path.join(dirname, file) for directory in directories for dirname, _, files in self.walk(directory) for file in filter(file_matcher, files)]
+
+class TestLocatorListener(sublime_plugin.EventListener):
+  def on_modified(self, view):
+    TestLocator.invalidate(view)
+
+  def on_close(self, view):
+    TestLocator.instances.pop(view.id(), None)
+
+
+class ProjectFileIndexListener(sublime_plugin.EventListener):
+  def on_post_save(self, view):
+    for index in ProjectFileIndex.containing(view.file_name() or ""):
+      index.add_file(view.file_name())
+
+  def on_activated(self, view):
+    """Keeps the indexes of the window fresh, and builds the ones of Ruby
+    projects ahead of the first command; other folders are left alone."""
+    window = view.window()
+    if not window:
+      return
+    s = sublime.load_settings("RubyTest.sublime-settings")
+    markers = ["Gemfile", s.get("ruby_rspec_folder"), s.get("ruby_unit_folder"), s.get("ruby_cucumber_folder")]
+    for folder in window.folders():
+      index = ProjectFileIndex.instances.get(folder)
+      if index is None and any(marker and os.path.exists(os.path.join(folder, marker)) for marker in markers):
+        index = ProjectFileIndex.for_folder(folder, s.get("ignored_directories"))
+      if index is not None:
+        index.revalidate_async()
 
 
 class RubyRailsGenerate(BaseRubyTask):
@@ -438,9 +2967,57 @@ class RubyRailsGenerate(BaseRubyTask):
     command = 'rails generate {thing}'.format(thing=argument)
     self.run_shell_command(command, self.window().folders()[0])
 
+class RestartRubyTestRunner(BaseRubyTask):
+  def is_enabled(self): return bool(WarmRunner.runners)
+  def run(self, args):
+    WarmRunner.stop_all()
+    sublime.status_message("RubyTest: warm runners stopped, they will boot again on the next run")
+
 class ShowTestPanel(BaseRubyTask):
   def run(self, args):
-    self.window().run_command("show_panel", {"panel": "output.exec"})
+    project_root = self.window().folders() and self.suite_root()
+    self.window().run_command("show_panel", {"panel": "output." + results_panel_name(self.window(), project_root)})
+
+class ShowRubyTestProfile(BaseRubyTask):
+  def run(self, args):
+    self.load_config()
+    if not PROFILE_PLUGIN:
+      sublime.status_message("RubyTest: profiling is off, enable \"profile_plugin\" in RubyTest.sublime-settings")
+    panel = self.window().get_output_panel("ruby_test_profile")
+    panel.run_command("append_ruby_test_output", {"characters": Profiler.report(), "erase": True})
+    self.window().run_command("show_panel", {"panel": "output.ruby_test_profile"})
+
+class ShowRubyTestHistory(BaseRubyTask):
+  def is_enabled(self): return bool(self.window().folders())
+  def run(self, args):
+    self.load_config()
+    project_root = self.suite_root()
+    sublime.status_message("RubyTest: reading the test history of %s" % project_root)
+    history = RunHistory.for_project(project_root)
+    threading.Thread(target=lambda: self.show(history.report())).start()
+
+  def show(self, report):
+    def display():
+      panel = self.window().get_output_panel("ruby_test_history")
+      panel.run_command("append_ruby_test_output", {"characters": report, "erase": True})
+      self.window().run_command("show_panel", {"panel": "output.ruby_test_history"})
+    sublime.set_timeout(display, 0)
+
+class ShowFullRubyTestOutput(BaseRubyTask):
+  def run(self, args):
+    self.load_config()
+    results_view = self.display_results(self.window().folders() and self.suite_root()).panel
+    path = OutputPanel.spill_path(results_view)
+    if not os.path.isfile(path):
+      return sublime.status_message("RubyTest: no test output yet")
+    self.window().open_file(path)
+
+class CancelRubyTest(BaseRubyTask):
+  def is_enabled(self): return bool(RunRegistry.runs)
+  def run(self, args):
+    project_roots = [root for root in RunRegistry.runs if self.view.file_name() and (self.view.file_name() + os.sep).startswith(root + os.sep)]
+    for project_root in project_roots or [root for root, run in RunRegistry.runs.items() if run.window.id() == self.window().id()]:
+      RunRegistry.cancel(project_root)
 
 class RubyExtractVariable(BaseRubyTask):
   def is_enabled(self): return 'extract_variable' in self.file_type().features()
@@ -459,56 +3036,141 @@ class RubyExtractVariable(BaseRubyTask):
     finally:
       self.view.end_edit(edit)
 
-class GenerateTestFile:
-  relative_paths = []
-  full_torelative_paths = {}
-  rel_path_start = 0
+class GenerateTestFile(object):
+  """Asks for the directory and name of a test file to create for the current
+  file (or, from a test, of the code file).
+
+  The directories come from the project file index. When it is still being
+  built the quick panel opens with the directories mirroring the current file
+  (spec/models/x for app/models/x, app/models/x for test/models/x, ...) and is
+  filled in once the index is ready; those directories are always listed first.
+  """
+  CODE_DIRECTORY = re.compile(r'app(\/|\\)|(lib|extras)$')
+  EXCLUDED_DIRECTORY = re.compile(r'assets|views|vendor')
 
-  def __init__(self, window, split_view):
+  def __init__(self, window, split_view=False):
     self.window = window
     self.split_view = split_view
-
+    view = window.active_view()
+    self.file_name = view and view.file_name()
+    self.folders = self.active_project(window.folders())
+    self.relative_paths = []
+    self.full_torelative_paths = {}
+    self.shown = 0
+    self.closed = False
+
+  @Profiler.command
   def doIt(self):
-    self.build_relative_paths()
-    self.window.show_quick_panel(self.relative_paths, self.dir_selected)
+    ignored_directories = sublime.load_settings("RubyTest.sublime-settings").get("ignored_directories")
+    indexes = [ProjectFileIndex.for_folder(folder, ignored_directories) for folder in self.folders]
+    if not [index for index in indexes if not index.ready.is_set()]:
+      with Profiler.phase("build_relative_paths"):
+        self.build_relative_paths()
+      return self.show()
+    self.relative_paths, self.full_torelative_paths = self.likely_paths(existing_only=True)
+    if self.relative_paths:
+      self.show()
+    def fill_in():
+      paths = self.collect_relative_paths()
+      sublime.set_timeout(lambda: self.filled_in(paths), 0)
+    threading.Thread(target=fill_in).start()
+
+  def filled_in(self, paths):
+    if not self.closed:
+      self.relative_paths, self.full_torelative_paths = paths
+      self.show()
+
+  def show(self):
+    self.shown += 1
+    shown = self.shown
+    def on_done(selected_index):
+      # a panel replaced by the filled in one is closed with -1
+      if shown == self.shown:
+        self.closed = True
+        self.dir_selected(selected_index)
+    self.window.show_quick_panel(self.relative_paths, on_done)
 
   def build_relative_paths(self):
-      folders = self.active_project(self.window.folders())
-      view = self.window.active_view()
-      self.relative_paths = []
-      self.full_torelative_paths = {}
-      for path in folders:
-          rootfolders = os.path.split(path)[-1]
-          self.rel_path_start = len(os.path.split(path)[0]) + 1
-          if self.is_valid_path(path):
-            self.full_torelative_paths[rootfolders] = path
-            self.relative_paths.append(rootfolders)
-
-          for base, dirs, files in os.walk(path):
-              for dir in dirs:
-                  relative_path = os.path.join(base, dir)[self.rel_path_start:]
-                  if self.is_valid_path(relative_path):
-                    self.full_torelative_paths[relative_path] = os.path.join(base, dir)
-                    self.relative_paths.append(relative_path)
+    self.relative_paths, self.full_torelative_paths = self.collect_relative_paths()
+
+  def collect_relative_paths(self):
+    """Valid directories of the active project as (labels, {label: directory}), likely ones first."""
+    is_valid_path = self.path_filter()
+    ignored_directories = sublime.load_settings("RubyTest.sublime-settings").get("ignored_directories")
+    relative_paths = []
+    full_torelative_paths = {}
+    for path in self.folders:
+      rel_path_start = len(os.path.dirname(path)) + 1
+      for directory in ProjectFileIndex.for_folder(path, ignored_directories).all_directories():
+        if is_valid_path(directory[len(path) + 1:]):
+          full_torelative_paths[directory[rel_path_start:]] = directory
+          relative_paths.append(directory[rel_path_start:])
+    likely = self.likely_paths()[0]
+    rank = dict((relative_path, n) for n, relative_path in enumerate(likely))
+    relative_paths.sort(key=lambda relative_path: rank.get(relative_path, len(rank)))
+    return relative_paths, full_torelative_paths
+
+  def likely_paths(self, existing_only=False):
+    """Directories where the new file most likely belongs, as collect_relative_paths returns them."""
+    is_valid_path = self.path_filter()
+    relative_paths = []
+    full_torelative_paths = {}
+    folder, parts = FolderTrie.for_folders(self.folders).lookup(self.file_name or "")
+    if not folder:
+      return relative_paths, full_torelative_paths
+    rel_path_start = len(os.path.dirname(folder)) + 1
+    for candidate in self.likely_directories(parts[:-1]):
+      directory = os.path.join(folder, *candidate)
+      relative_path = directory[rel_path_start:]
+      if relative_path not in full_torelative_paths and is_valid_path(os.sep.join(candidate)) and (not existing_only or os.path.isdir(directory)):
+        full_torelative_paths[relative_path] = directory
+        relative_paths.append(relative_path)
+    return relative_paths, full_torelative_paths
+
+  def likely_directories(self, parts):
+    """Test directories mirroring the code directory parts, or code directories
+    mirroring the test directory parts, deepest first. Whatever precedes the
+    test / app / lib folder (engines/billing/...) is kept."""
+    test_folders = [RSPEC_UNIT_FOLDER, RUBY_UNIT_FOLDER, CUCUMBER_UNIT_FOLDER]
+    tests = [n for n, part in enumerate(parts) if part in test_folders]
+    code = [n for n, part in enumerate(parts) if part in ("app", "lib")]
+    if tests:
+      prefix, parts = parts[:tests[0]], parts[tests[0] + 1:]
+      roots = parts[:1] == ["lib"] and [prefix] or [prefix + ["app"], prefix + ["lib"]]
+    else:
+      start = code and code[0] or 0
+      prefix, parts = parts[:start], parts[start:]
+      parts = parts[:1] == ["app"] and parts[1:] or parts
+      roots = [prefix + [folder] for folder in test_folders]
+    return [root + parts[:depth] for depth in range(len(parts), -1, -1) for root in roots]
+
+  def path_filter(self):
+    """Filter of the directories (relative to their project folder) to offer."""
+    if self.from_test():
+      return lambda path: self.CODE_DIRECTORY.search(path) and not self.EXCLUDED_DIRECTORY.search(path)
+    return self.test_path().search
+
+  def from_test(self):
+    return bool(self.file_name and self.test_path().search(self.relative(self.file_name)))
+
+  def test_path(self):
+    """Matches paths with a test folder as one of their components."""
+    return re.compile(r"(?:^|[\\/])(?:%s)(?:[\\/]|$)" % self.test_path_re())
+
+  def relative(self, path):
+    """path relative to the project folder containing it."""
+    folder, parts = FolderTrie.for_folders(self.folders).lookup(path)
+    return folder and os.sep.join(parts) or path
 
   def active_project(self, folders):
-    for folder in folders:
-      project_name = os.path.split(folder)[-1]
-      if re.search(project_name, self.current_file()):
-        return [folder]
-    return folders
-
-  def is_valid_path(self, path):
-    if re.search(self.test_path_re(), self.current_file()):
-      return re.search('app(\/|\\\)|(lib|extras)$', path) and not re.search('assets|views|vendor', path)
-    else:
-      return re.search(self.test_path_re(), path)
+    folder, _ = FolderTrie.for_folders(folders).lookup(self.file_name or "")
+    return folder and [folder] or folders
 
   def test_path_re(self):
     return RUBY_UNIT_FOLDER + '|' + RSPEC_UNIT_FOLDER + '|' + CUCUMBER_UNIT_FOLDER
 
   def current_file(self):
-    return self.window.active_view().file_name()
+    return self.file_name
 
   def dir_selected(self, selected_index):
       if selected_index != -1:
@@ -521,12 +3183,13 @@ class GenerateTestFile:
     return self.set_file_name(path, current_file)
 
   def set_file_name(self, path, current_file):
-    if re.search(self.test_path_re(), self.current_file()):
+    if self.from_test():
       return re.sub('_test.rb|_spec.rb|.feature', '.rb', current_file)
     else:
       return current_file.replace('.rb', self.detect_test_type(path))
 
   def detect_test_type(self, path):
+    path = self.relative(path)
     if re.search(RUBY_UNIT_FOLDER, path):
       return '_test.rb'
     if re.search(RSPEC_UNIT_FOLDER, path):
@@ -568,15 +3231,17 @@ class GenerateFile(sublime_plugin.WindowCommand):
     GenerateNewFile(self.window).doIt()
 
 class GenerateNewFile(GenerateTestFile):
-  def __init__(self, window):
-    self.window = window
-    self.split_view = False
+  DOTTED = re.compile(r'\.\w+')
 
   def active_project(self, folders):
     return folders
 
-  def is_valid_path(self, path):
-    return not re.search('\.\w+', path)
+  def likely_directories(self, parts):
+    """The current file's directory and its parents."""
+    return [parts[:depth] for depth in range(len(parts), -1, -1)]
+
+  def path_filter(self):
+    return lambda path: not self.DOTTED.search(path)
 
   def suggest_file_name(self, path):
     return ""
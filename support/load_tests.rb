@@ -0,0 +1,9 @@
+# RubyTest test file loader.
+#
+# ruby -Itest load_tests.rb a_test.rb b_test.rb ... requires every test file
+# given before the first option, so a parallel suite job boots ruby (and the
+# app) once for a whole batch of minitest / test-unit files instead of once
+# per file. The remaining arguments are left in ARGV for the test framework.
+files = ARGV.take_while { |arg| !arg.start_with?('-') }
+ARGV.shift(files.size)
+files.each { |file| require File.expand_path(file) }
@@ -0,0 +1,77 @@
+# RubyTest minitest reporter.
+#
+# Picked up by Minitest.load_plugins when run_ruby_test.py puts support/ on
+# RUBYLIB and sets RUBYTEST_FORMAT. Replaces the progress and summary
+# reporters with one JSON line per test, prefixed with MARKER.
+require 'json'
+
+module Minitest
+  def self.plugin_rubytest_init(options)
+    return unless ENV['RUBYTEST_FORMAT'] == 'json'
+    reporter.reporters.reject! { |r| r.is_a?(ProgressReporter) || r.is_a?(SummaryReporter) }
+    reporter << RubyTestReporter.new(options[:io])
+  end
+
+  class RubyTestReporter < AbstractReporter
+    MARKER = "\x1eRUBYTEST "
+    SUPPORT_DIR = File.expand_path('..', File.dirname(__FILE__))
+
+    def initialize(io)
+      @io = io
+      @failures = 0
+    end
+
+    def start
+      @started_at = Time.now
+    end
+
+    def record(result)
+      klass = result.respond_to?(:klass) ? result.klass : result.class.name
+      file, line = result.source_location if result.respond_to?(:source_location)
+      file, line = result.method(result.name).source_location if file.nil? && result.respond_to?(result.name)
+      status = result.skipped? ? 'pending' : result.passed? ? 'passed' : 'failed'
+      event = {
+        'event' => 'example',
+        'status' => status,
+        'file' => relative(file),
+        'line' => line,
+        'class' => klass,
+        'name' => result.name,
+        'description' => "#{klass}##{result.name}",
+        'duration' => result.time
+      }
+      if (failure = result.failure)
+        event['message'] = failure.message
+        backtrace = Minitest.filter_backtrace(failure.backtrace || []).reject { |l| l.start_with?(SUPPORT_DIR) }
+        event['backtrace'] = backtrace.map { |l| relative(l) }
+        if status == 'failed'
+          @failures += 1
+          # file / line stay the test's own, so reruns and failure bookkeeping
+          # find it; where it failed (often app code or a helper) goes apart
+          location = failure.location.to_s.match(/\A(.+):(\d+)/)
+          event['location'] = "#{relative(location[1])}:#{location[2]}" if location
+        end
+      end
+      write event
+    end
+
+    def report
+      write 'event' => 'summary', 'duration' => Time.now - @started_at
+    end
+
+    def passed?
+      @failures.zero?
+    end
+
+    private
+
+    def relative(path)
+      path && path.sub(/\A#{Regexp.escape(Dir.pwd)}\//, '')
+    end
+
+    def write(event)
+      @io.puts MARKER + JSON.generate(event)
+      @io.flush
+    end
+  end
+end
@@ -0,0 +1,56 @@
+# RubyTest RSpec formatter.
+#
+# Streams one JSON line per example, prefixed with MARKER, for the result
+# parser in run_ruby_test.py. Loaded with
+#
+#   rspec --require .../support/rspec_formatter.rb --format RubyTestFormatter
+require 'json'
+require 'rspec/core'
+require 'rspec/core/formatters/base_formatter'
+
+class RubyTestFormatter < RSpec::Core::Formatters::BaseFormatter
+  MARKER = "\x1eRUBYTEST "
+
+  RSpec::Core::Formatters.register self, :message, :example_passed, :example_failed, :example_pending, :dump_summary
+
+  def message(notification)
+    output.puts notification.message
+  end
+
+  def example_passed(notification)
+    emit notification.example, 'passed'
+  end
+
+  def example_pending(notification)
+    emit notification.example, 'pending', 'message' => notification.example.execution_result.pending_message
+  end
+
+  def example_failed(notification)
+    emit notification.example, 'failed',
+      'message' => notification.message_lines.join("\n").strip,
+      'backtrace' => notification.formatted_backtrace
+  end
+
+  def dump_summary(summary)
+    write 'event' => 'summary', 'duration' => summary.duration, 'load_time' => summary.load_time
+  end
+
+  private
+
+  def emit(example, status, details = {})
+    write({
+      'event' => 'example',
+      'status' => status,
+      'id' => example.id.sub(%r{\A\./}, ''),
+      'file' => example.metadata[:file_path].sub(%r{\A\./}, ''),
+      'line' => example.metadata[:line_number],
+      'description' => example.full_description,
+      'duration' => example.execution_result.run_time
+    }.merge(details))
+  end
+
+  def write(event)
+    output.puts MARKER + JSON.generate(event)
+    output.flush
+  end
+end
@@ -0,0 +1,28 @@
+# RubyTest coverage collector.
+#
+# Loaded through RUBYOPT (-rrubytest_coverage) when "collect_coverage" is
+# enabled. When the run exits, appends one JSON line to RUBYTEST_COVERAGE
+# listing the spec / test files that ran and the other project files they
+# executed; TestCoverage in run_ruby_test.py uses it to find the tests
+# affected by a change.
+require 'coverage'
+
+Coverage.start
+
+at_exit do
+  root = Dir.pwd + '/'
+  tests, sources = [], []
+  executed = Coverage.result.select { |_, lines| lines.any? { |count| count && count > 0 } }.keys
+  # the script ruby was started with (ruby -Itest some_test.rb) is not tracked
+  executed << File.expand_path($0)
+  executed.uniq.each do |path|
+    next unless path.start_with?(root)
+    relative = path[root.size..-1]
+    next if relative.start_with?('vendor/')
+    (relative =~ %r{(_spec|_test)\.rb\z|(\A|/)test_[^/]+\.rb\z} ? tests : sources) << relative
+  end
+  unless tests.empty? || ENV['RUBYTEST_COVERAGE'].to_s.empty?
+    require 'json'
+    File.open(ENV['RUBYTEST_COVERAGE'], 'a') { |log| log.puts JSON.generate('tests' => tests, 'sources' => sources) }
+  end
+end
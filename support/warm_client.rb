@@ -0,0 +1,72 @@
+# RubyTest warm runner client.
+#
+# Hands a test command to warm_runner.rb, streams its output and exits with
+# the status of the test run.
+#
+#   ruby --disable-gems warm_client.rb SOCKET_PATH SERVER_PID LOG_PATH COMMAND...
+require 'socket'
+require 'json'
+
+EXIT_MARKER = "\0RUBYTEST-EXIT "
+
+socket_path, server_pid, log_path = ARGV.shift(3)
+$stdout.sync = true
+
+# The environment sent to the runner may hold credentials: only talk to a
+# socket of this user in a directory no one else can write to.
+def private_socket?(path)
+  directory, socket = File.lstat(File.dirname(path)), File.lstat(path)
+  directory.directory? && directory.uid == Process.uid && directory.mode & 0o077 == 0 &&
+    socket.socket? && socket.uid == Process.uid
+end
+
+begin
+  unless private_socket?(socket_path)
+    $stderr.puts "RubyTest warm runner: #{socket_path} is not a private socket of this user, not using it"
+    exit 1
+  end
+  socket = UNIXSocket.new(socket_path)
+rescue Errno::ENOENT, Errno::ECONNREFUSED
+  begin
+    Process.kill(0, server_pid.to_i)
+  rescue Errno::ESRCH
+    $stderr.puts "RubyTest warm runner failed to start:"
+    $stderr.puts File.read(log_path) if File.exist?(log_path)
+    exit 1
+  end
+  sleep 0.05
+  retry
+end
+
+socket.puts(JSON.generate('argv' => ARGV, 'cwd' => Dir.pwd, 'env' => ENV.to_hash))
+
+['TERM', 'INT'].each do |signal|
+  trap(signal) do
+    socket.close rescue nil
+    exit 1
+  end
+end
+
+pending = ''.b
+status = 1
+loop do
+  begin
+    pending << socket.readpartial(65536)
+  rescue EOFError
+    break
+  end
+  if (index = pending.index(EXIT_MARKER))
+    $stdout.write(pending[0...index])
+    pending = pending[index..-1]
+  elsif pending.bytesize > EXIT_MARKER.bytesize
+    $stdout.write(pending[0...-EXIT_MARKER.bytesize])
+    pending = pending[-EXIT_MARKER.bytesize..-1]
+  end
+end
+
+if pending.start_with?(EXIT_MARKER)
+  status = pending[EXIT_MARKER.bytesize..-1].to_i
+else
+  $stdout.write(pending)
+end
+exit status
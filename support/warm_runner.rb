@@ -0,0 +1,134 @@
+# RubyTest warm runner.
+#
+# Boots the project once (bundler, Rails environment, test frameworks) and then
+# forks a fresh child for every rspec / ruby -Itest / cucumber run requested
+# over a unix socket by warm_client.rb. Started, restarted and stopped by
+# WarmRunner in run_ruby_test.py.
+#
+#   ruby warm_runner.rb SOCKET_PATH
+require 'socket'
+require 'json'
+
+module RubyTestWarmRunner
+  EXIT_MARKER = "\0RUBYTEST-EXIT "
+
+  def self.preload
+    ENV['RAILS_ENV'] ||= 'test'
+    ENV['RACK_ENV'] ||= 'test'
+    require 'bundler/setup' if File.exist?('Gemfile')
+    require File.expand_path('config/environment') if File.exist?('config/environment.rb')
+    ['rspec/core', 'minitest', 'cucumber/cli/main'].each do |library|
+      begin
+        require library
+      rescue LoadError
+      end
+    end
+  end
+
+  def self.serve(socket_path)
+    File.unlink(socket_path) if File.exist?(socket_path)
+    server = UNIXServer.new(socket_path)
+    server_pid = Process.pid
+    at_exit { File.unlink(socket_path) if Process.pid == server_pid && File.exist?(socket_path) }
+    trap('TERM') { exit }
+    trap('INT') { exit }
+
+    loop do
+      client = server.accept
+      request = JSON.parse(client.gets)
+      disconnect
+      pid = fork { run_child(server, client, request) }
+      supervise(client, pid)
+    end
+  end
+
+  def self.run_child(server, client, request)
+    server.close
+    trap('TERM', 'DEFAULT')
+    trap('INT', 'DEFAULT')
+    $stdin.reopen(File::NULL)
+    $stdout.reopen(client)
+    $stderr.reopen(client)
+    $stdout.sync = $stderr.sync = true
+    Dir.chdir(request['cwd'])
+    ENV.replace(request['env'])
+    ENV['RUBYLIB'].to_s.split(File::PATH_SEPARATOR).reverse_each do |directory|
+      $LOAD_PATH.unshift(directory) unless $LOAD_PATH.include?(directory)
+    end
+    reconnect
+    exit run(request['argv'])
+  end
+
+  # Reports the child's exit status once it is done and kills it when the
+  # client goes away (cancelled run).
+  def self.supervise(client, pid)
+    finished = false
+    Thread.new do
+      _, status = Process.wait2(pid)
+      finished = true
+      begin
+        client.write("#{EXIT_MARKER}#{status.exitstatus || 1}\n")
+      rescue IOError, SystemCallError
+      end
+      client.close
+    end
+    Thread.new do
+      begin
+        client.read
+      rescue IOError, SystemCallError
+      end
+      Process.kill('TERM', pid) rescue nil unless finished
+    end
+  end
+
+  def self.run(argv)
+    command, *args = argv
+    case File.basename(command)
+    when 'rspec'
+      require 'rspec/core'
+      RSpec.configuration.backtrace_exclusion_patterns << /#{Regexp.escape(__FILE__)}/
+      RSpec::Core::Runner.run(args, $stderr, $stdout).to_i
+    when 'cucumber'
+      require 'cucumber/cli/main'
+      Cucumber::Cli::Main.new(args).execute!
+    when 'ruby'
+      run_ruby(args)
+    else
+      $stderr.puts "RubyTest warm runner can't run #{command}"
+      1
+    end
+  end
+
+  # ruby -Itest path/to/some_test.rb -n test_name: the test framework's
+  # at_exit hook runs the tests once the file is loaded.
+  def self.run_ruby(args)
+    while args.first && args.first.start_with?('-I')
+      option = args.shift
+      directory = option == '-I' ? args.shift : option[2..-1]
+      $LOAD_PATH.unshift(File.expand_path(directory))
+    end
+    file = args.shift
+    ARGV.replace(args)
+    $0 = file
+    load File.expand_path(file)
+    0
+  end
+
+  def self.disconnect
+    ActiveRecord::Base.connection_pool.disconnect! if defined?(ActiveRecord::Base) && ActiveRecord::Base.connected?
+  end
+
+  # database.yml is evaluated again so parallel workers pick up their own
+  # TEST_ENV_NUMBER database.
+  def self.reconnect
+    return unless defined?(ActiveRecord::Base)
+    if ENV['TEST_ENV_NUMBER'] && defined?(Rails) && Rails.application
+      config = Rails.application.config.database_configuration[Rails.env]
+      return ActiveRecord::Base.establish_connection(config) if config
+    end
+    ActiveRecord::Base.establish_connection
+  end
+end
+
+RubyTestWarmRunner.preload
+RubyTestWarmRunner.serve(ARGV.fetch(0))